@@ -0,0 +1,68 @@
+import os
+import json
+import shutil
+import argparse
+import h5py
+import numpy as np
+import tqdm
+from data.index import HDF5_NAME, load_index
+from data.shards import MANIFEST_NAME, shard_name
+
+
+def convert(src_path, dst_path, chunk_rows=1024):
+    """
+    Rewrites GOLD_XYZ_OSC.0001_1024.hdf5 into one contiguous .npy shard per modulation-snr block
+    """
+    os.makedirs(dst_path, exist_ok=True)
+    h5_path = os.path.join(src_path, HDF5_NAME)
+    stat = os.stat(h5_path)
+
+    index = load_index(src_path)
+    starts = np.flatnonzero(index.pos == 0)
+    stops = np.append(starts[1:], len(index))
+
+    blocks = []
+    with h5py.File(h5_path, 'r') as f:
+        iq = f['X']
+        for start, stop in zip(tqdm.tqdm(starts), stops):
+            label = int(index.label[start])
+            snr = int(index.snr[start])
+            file_name = shard_name(label, snr)
+
+            shard = np.lib.format.open_memmap(os.path.join(dst_path, file_name), mode='w+',
+                                              dtype=iq.dtype, shape=(int(stop - start),) + iq.shape[1:])
+            for offset in range(start, stop, chunk_rows):
+                end = min(offset + chunk_rows, stop)
+                shard[offset - start:end - start] = iq[offset:end]
+            shard.flush()
+            del shard
+
+            blocks.append({'label': label, 'snr': snr, 'file': file_name, 'num_frames': int(stop - start)})
+
+        manifest = {
+            'source': h5_path,
+            'src_size': stat.st_size,
+            'src_mtime_ns': stat.st_mtime_ns,
+            'frame_shape': list(iq.shape[1:]),
+            'dtype': str(iq.dtype),
+            'blocks': blocks
+        }
+
+    classes_path = os.path.join(src_path, "classes-fixed.json")
+    if os.path.exists(classes_path):
+        shutil.copy(classes_path, os.path.join(dst_path, "classes-fixed.json"))
+
+    with open(os.path.join(dst_path, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert RadioML2018 HDF5 into per-(modulation, snr) shards.')
+    parser.add_argument('src', type=str, help='directory of GOLD_XYZ_OSC.0001_1024.hdf5')
+    parser.add_argument('dst', type=str, help='output directory, use it as dataset_path in config.yaml')
+
+    args = parser.parse_args()
+    manifest = convert(args.src, args.dst)
+    print(f"Wrote {len(manifest['blocks'])} shards to {args.dst}")
@@ -1,15 +1,13 @@
 import os
-import h5py
 import json
 import pickle
 import numpy as np
-import random
+import torch
 import torch.utils.data as data
-from data.transform import AMCTransform
+from data.transform import pad_frames, supervised_input
+from data.reader import open_index, open_reader
+from data.plan import load_episode_plan
 from runner.utils import get_config
-from numpy import argwhere
-
-random.seed(50)
 
 
 class AMCTrainDataset(data.Dataset):
@@ -18,65 +16,44 @@ class AMCTrainDataset(data.Dataset):
 
         self.config = config
         self.root_path = self.config['dataset_path']
-        self.snr_range = self.config['tain_snr_range']
-        self.transforms = AMCTransform()
+        self.snr_range = self.config['train_snr_range']
         self.robust = robust
 
-        self.data = h5py.File(os.path.join(self.root_path, "GOLD_XYZ_OSC.0001_1024.hdf5"), 'r')
         self.class_labels = json.load(open(os.path.join(self.root_path, "classes-fixed.json"), 'r'))
 
-        self.iq = self.data['X']
-        self.onehot = self.data['Y']
-        self.snr = np.squeeze(self.data['Z'])
-        self.num_modulation = 24
-        self.num_sample = int(4096 * self.config['train_proportion'])  # sample per modulation-snr
-        self.sample_len = self.config['train_sample_size']
-
-        # Sampling data in snr boundary
-        if self.snr_range is not None:
-            snr_mask = (self.snr_range[0] <= self.snr) & (self.snr <= self.snr_range[1])
-            self.iq = self.iq[snr_mask]
-            self.onehot = self.onehot[snr_mask]
-            self.snr = self.snr[snr_mask]
-
-        mod_mask = np.array([int(argwhere(self.onehot[i] == 1)) in self.config['train_class_indices'] for i in
-                             range(len(self.onehot))])
         self.num_modulation = len(self.config['train_class_indices'])
+        self.num_sample = int(4096 * self.config['train_proportion'])  # sample per modulation-snr
+        self.sample_len = self.config['train_sample_len']
 
-        self.iq = self.iq[mod_mask]
-        self.onehot = self.onehot[mod_mask]
-        self.snr = self.snr[mod_mask]
-
-        # Sampling train data
-        # each modulation-snr has 4096 I/Q samples
-        sampling_mask = []
-        for _ in range(self.num_modulation * len(np.unique(self.snr))):
-            sampling_mask.extend([True for _ in range(self.num_sample)])
-            sampling_mask.extend([False for _ in range(4096-self.num_sample)])
-        sampling_mask = np.array(sampling_mask)
+        # Sampling train data in snr boundary
+        # each modulation-snr has 4096 I/Q samples, the first num_sample of them are used for training
+        index = open_index(self.root_path)
+        rows = index.select(self.config['train_class_indices'], snr_range=self.snr_range,
+                            split='train', num_sample=self.num_sample)
 
-        self.iq = self.iq[sampling_mask]
-        self.onehot = self.onehot[sampling_mask]
-        self.snr = self.snr[sampling_mask]
+        # frames are read on demand from the HDF5 file or the memory-mapped shards,
+        # an HDF5 split is cached in RAM only if it fits config['ram_budget']
+        self.iq = open_reader(self.root_path, rows, ram_budget=self.config['ram_budget'])
+        self.label = index.label[rows]
+        self.snr = index.snr[rows]
 
     def __len__(self):
-        return self.iq.shape[0]
+        return len(self.iq)
 
     def __getitem__(self, item):
-        label = int(argwhere(self.onehot[item] == 1))
-        x = self.iq[item].transpose()
+        return self._make_sample(self.iq[item], item)
 
-        if self.robust is True:
-            revers = np.flip(x.copy(), axis=1)
-            x = np.concatenate((x, revers), axis=0)
-            sample = {"data": self.transforms(x), "label": label, "snr": self.snr[item]}  # self.transforms(x)
-        else:
-            if self.config['model'] == 'daelstm':
-                x = x.reshape((1024, 2))
-            else:
-                x = np.expand_dims(x, axis=1)
-            sample = {"data": x, "label": label, "snr": self.snr[item]}
+    def __getitems__(self, items):
+        # one chunk-coalesced read for the whole batch
+        return [self._make_sample(frame, item) for frame, item in zip(self.iq.take(items), items)]
+
+    def _make_sample(self, frame, item):
+        # [I/Q, data_length] view of the frame, the model input layout is built per batch in collate
+        return {"data": frame.transpose(), "label": int(self.label[item]), "snr": self.snr[item]}
 
+    def collate(self, batch):
+        sample = data.default_collate(batch)
+        sample["data"] = supervised_input(sample["data"], self.config['model'], robust=self.robust)
         return sample
 
 
@@ -87,69 +64,45 @@ class AMCTestDataset(data.Dataset):
         self.config = config
         self.root_path = self.config['dataset_path']
         self.snr_range = snr_range
-        self.transforms = AMCTransform()
         self.robust = robust
        
-        self.data = h5py.File(os.path.join(self.root_path, "GOLD_XYZ_OSC.0001_1024.hdf5"), 'r')
         self.class_labels = json.load(open(os.path.join(self.root_path, "classes-fixed.json"), 'r'))
 
-        self.iq = self.data['X']
-        self.onehot = self.data['Y']
-        self.snr = np.squeeze(self.data['Z'])
-        self.num_modulation = 24
+        self.num_modulation = len(self.config['test_class_indices'])
         self.num_sample = 4096 - int(4096 * self.config['train_proportion'])  # sample per modulation-snr
         self.sample_len = sample_len
 
-        # Sampling data in snr boundary
-        if self.snr_range is not None:
-            snr_mask = (self.snr_range[0] <= self.snr) & (self.snr <= self.snr_range[1])
-            self.iq = self.iq[snr_mask]
-            self.onehot = self.onehot[snr_mask]
-            self.snr = self.snr[snr_mask]
-
-        mod_mask = np.array([int(argwhere(self.onehot[i] == 1)) in self.config['test_class_indices'] for i in
-                             range(len(self.onehot))])
-        self.num_modulation = len(self.config['test_class_indices'])
-
-        self.iq = self.iq[mod_mask]
-        self.onehot = self.onehot[mod_mask]
-        self.snr = self.snr[mod_mask]
+        # Sampling test data in snr boundary
+        # each modulation-snr has 4096 I/Q samples, the last num_sample of them are used for testing
+        index = open_index(self.root_path)
+        rows = index.select(self.config['test_class_indices'], snr_range=self.snr_range,
+                            split='test', num_sample=self.num_sample)
 
-        # Sampling train data
-        # each modulation-snr has 4096 I/Q samples
-        sampling_mask = []
-        for _ in range(self.num_modulation * len(np.unique(self.snr))):
-            sampling_mask.extend([False for _ in range(4096 - self.num_sample)])
-            sampling_mask.extend([True for _ in range(self.num_sample)])
-        sampling_mask = np.array(sampling_mask)
-
-        self.iq = self.iq[sampling_mask]
-        self.onehot = self.onehot[sampling_mask]
-        self.snr = self.snr[sampling_mask]
+        # frames are read on demand from the HDF5 file or the memory-mapped shards, limited to sample_len samples,
+        # an HDF5 split is cached in RAM only if it fits config['ram_budget']
+        self.iq = open_reader(self.root_path, rows, sample_len=self.sample_len, ram_budget=self.config['ram_budget'])
+        self.label = index.label[rows]
+        self.snr = index.snr[rows]
 
     def __len__(self):
-        return self.iq.shape[0]
+        return len(self.iq)
 
     def __getitem__(self, item):
-        label = int(argwhere(self.onehot[item] == 1))
-        x = self.iq[item].transpose()
-
-        # self duplication
-        if self.sample_len != 1024:
-            num_dup = (1024 // self.sample_len)
-            x = np.array(np.concatenate([self.iq[item].transpose()[:, :self.sample_len] for _ in range(num_dup)], axis=1))
-
-        if self.robust is True:
-            revers = np.flip(x.copy(), axis=1)
-            x = np.concatenate((x, revers), axis=0)
-            sample = {"data": self.transforms(x), "label": label, "snr": self.snr[item]}  # self.transforms(x)
-        else:
-            if self.config['model_name'] == 'daelstm':
-                x = x.reshape((1024, 2))
-            else:
-                x = np.expand_dims(x, axis=1)
-            sample = {"data": x, "label": label, "snr": self.snr[item]}
+        return self._make_sample(self.iq[item], item)
+
+    def __getitems__(self, items):
+        # one chunk-coalesced read for the whole batch
+        return [self._make_sample(frame, item) for frame, item in zip(self.iq.take(items), items)]
 
+    def _make_sample(self, frame, item):
+        # [I/Q, sample_len] view of the frame, padding and the model input layout are applied per batch in collate
+        return {"data": frame.transpose(), "label": int(self.label[item]), "snr": self.snr[item]}
+
+    def collate(self, batch):
+        sample = data.default_collate(batch)
+        # self duplication of short frames up to 1024 samples
+        x = pad_frames(sample["data"], 1024, 'self_duplicate')
+        sample["data"] = supervised_input(x, self.config['model'], robust=self.robust)
         return sample
 
 
@@ -162,99 +115,120 @@ class FewShotDataset(data.Dataset):
         self.num_sample = int(4096 * self.config['train_proportion'])  # sample
         self.padding = self.config['padding']
         
-        self.data = h5py.File(os.path.join(self.root_path, "GOLD_XYZ_OSC.0001_1024.hdf5"), 'r')
         self.class_labels = json.load(open(os.path.join(self.root_path, "classes-fixed.json"), 'r'))
         self.train_sample_len = train_sample_len
         self.test_sample_len = sample_len
 
-        self.iq = self.data['X']
-        self.onehot = self.data['Y']
-        self.snr = np.squeeze(self.data['Z'])
-
-        # Sampling data in snr boundary
-        if self.snr_range is not None:
-            snr_mask = (self.snr_range[0] <= self.snr) & (self.snr <= self.snr_range[1])
-            self.iq = self.iq[snr_mask]
-            self.onehot = self.onehot[snr_mask]
-            self.snr = self.snr[snr_mask]
-
         # Sampling class
         assert mode in ['train', 'test']
-        if mode == 'train':
-            mod_mask = np.array([int(argwhere(self.onehot[i] == 1)) in self.config['train_class_indices'] for i in
-                                 range(len(self.onehot))])
-            self.num_modulation = len(self.config['train_class_indices'])
-        elif mode == 'test':
-            mod_mask = np.array([int(argwhere(self.onehot[i] == 1)) in self.config['test_class_indices'] for i in
-                                 range(len(self.onehot))])
-            self.num_modulation = len(self.config['test_class_indices'])
-
-        self.iq = self.iq[mod_mask]
-        self.onehot = self.onehot[mod_mask]
-        self.snr = self.snr[mod_mask]
-
-        # Sampling train data
-        # each modulation-snr has 4096 I/Q samples
-        if mode == 'train':
-            sampling_mask = []
-            for _ in range(self.num_modulation * len(np.unique(self.snr))):
-                sampling_mask.extend([True for _ in range(self.num_sample)])
-                sampling_mask.extend([False for _ in range(4096 - self.num_sample)])
-            sampling_mask = np.array(sampling_mask)
-        # Sampling test data
-        else:
-            sampling_mask = []
-            for _ in range(self.num_modulation * len(np.unique(self.snr))):
-                sampling_mask.extend([False for _ in range(4096 - self.num_sample)])
-                sampling_mask.extend([True for _ in range(self.num_sample)])
-            sampling_mask = np.array(sampling_mask)
+        class_indices = self.config['train_class_indices'] if mode == 'train' else self.config['test_class_indices']
+        self.num_modulation = len(class_indices)
+
+        # Sampling data in snr boundary
+        # each modulation-snr has 4096 I/Q samples,
+        # train uses the first num_sample of them and test the last num_sample
+        index = open_index(self.root_path)
+        rows = index.select(class_indices, snr_range=self.snr_range, split=mode, num_sample=self.num_sample)
 
-        self.iq = self.iq[sampling_mask]
-        self.onehot = self.onehot[sampling_mask]
-        self.snr = self.snr[sampling_mask]
+        # only the first test_sample_len samples of each frame are read
+        self.iq = open_reader(self.root_path, rows, sample_len=self.test_sample_len, ram_budget=self.config['ram_budget'])
+        self.snr = index.snr[rows]
 
         # Extract class labels
-        self.label_list = [int(argwhere(self.onehot[i] == 1)) for i in range(len(self.snr))]
+        self.label_list = index.label[rows]
         self.labels = np.unique(self.label_list)
 
         # Extract indices of each labels
-        self.label_indices = {label: [i for i, x in enumerate(self.label_list) if x == label] for label in self.labels}
+        self.label_indices = {label: np.flatnonzero(self.label_list == label) for label in self.labels}
+
+        # replaced by a per-worker generator in seed_worker when episodes are loaded by worker processes
+        self.rng = np.random.default_rng(self.config['seed'])
 
         # few-shot variables
         self.num_support = self.config["num_support"]
         self.num_query = self.config["num_query"]
         self.num_episode = len(self.snr) // ((self.num_support + self.num_query) * len(self.labels))
 
+        # test episodes are replayed from a seeded plan stored on disk, so every model sees the same episodes,
+        # the plan is only built once episodes are drawn from this split (whole-range splits use per-SNR plans)
+        self.plan = None
+        self.use_plan = mode == 'test' and self.config['episode_plan']
+
+    def load_plan(self):
+        if self.use_plan and self.plan is None:
+            self.plan = load_episode_plan(self.config['episode_plan_path'], self.label_list,
+                                          self.num_support, self.num_query, self.num_episode, self.config['seed'])
+        return self.plan
+
     def __len__(self):
         return self.num_episode
 
     def __getitem__(self, idx):
-        # idx means index of episode
-        sample = dict()
-    
-        for label in self.labels:
-            sample[label] = dict()
-            label_indices = self.label_indices[label]
-
-            # support set
-            support_indices = random.sample(label_indices, self.num_support)
-            support_set = [self.iq[i].transpose()[:, :self.test_sample_len] for i in support_indices]
-            sample[label]['support'] = support_set
-
-            # query set
-            query_indices = list(set(label_indices) - set(support_indices))
-            query_indices = random.sample(query_indices, self.num_query)
-            query_set = None
-            if self.mode == 'train':
-                query_set = [self.iq[i].transpose()[:, :self.test_sample_len] for i in query_indices]
-            else:
-                if self.padding == 'self_duplicate':
-                    num_dup = (self.train_sample_len // self.test_sample_len)
-                    query_set = [np.concatenate([self.iq[i].transpose()[:, :self.test_sample_len] for _ in range(num_dup)], axis=1) for i in query_indices]
-                elif self.padding == 'zero':
-                    query_set = [np.concatenate((self.iq[i].transpose()[:, :self.test_sample_len], 
-                                                np.zeros((2, self.train_sample_len-self.test_sample_len),dtype=np.float32)), axis=1) for i in query_indices]
-
-            sample[label]['query'] = query_set
-
-        return sample
\ No newline at end of file
+        """
+        idx means index of episode
+        Returns:
+            support: [n_way, num_support, I/Q, data_length]
+            query: [n_way, num_query, I/Q, data_length]
+            (test frames keep their test_sample_len, they are padded in collate)
+            target: [n_way, num_query] target indices 0 ... n_way-1
+            label: [n_way] modulation id of each way
+        """
+        n_way = len(self.labels)
+        num_shot = self.num_support + self.num_query
+
+        # support and query are drawn together so they never share a frame
+        plan = self.load_plan()
+        if plan is not None:
+            positions = plan[idx]
+        else:
+            positions = np.stack([self.rng.choice(self.label_indices[label], num_shot, replace=False)
+                                  for label in self.labels])
+
+        # one sorted read for every frame of the episode: [n_way * num_shot, length, I/Q]
+        frames = self.iq.take(positions.reshape(-1))
+        frames = frames[:, :self.test_sample_len].transpose(0, 2, 1)
+        frames = frames.reshape(n_way, num_shot, 2, -1)
+        frames = torch.from_numpy(np.ascontiguousarray(frames))
+
+        return {
+            'support': frames[:, :self.num_support],
+            'query': frames[:, self.num_support:],
+            'target': torch.arange(n_way).view(n_way, 1).expand(n_way, self.num_query),
+            'label': torch.from_numpy(self.labels.astype(np.int64))
+        }
+
+    def collate(self, batch):
+        sample = collate_episodes(batch)
+        # short test frames are extended to the encoder frame length once per batch of episodes
+        if self.mode == 'test':
+            sample['support'] = pad_frames(sample['support'], self.train_sample_len, self.padding)
+            sample['query'] = pad_frames(sample['query'], self.train_sample_len, self.padding)
+        return sample
+
+
+def collate_episodes(batch):
+    # stacks episodes into [num_episode, n_way, num_shot, I/Q, data_length] tensors
+    return {key: torch.stack([episode[key] for episode in batch]) for key in batch[0]}
+
+
+def seed_worker(worker_id):
+    # every worker draws episodes from its own generator, seeded from the DataLoader base seed
+    worker_info = data.get_worker_info()
+    if hasattr(worker_info.dataset, 'rng'):
+        worker_info.dataset.rng = np.random.default_rng(worker_info.seed)
+
+
+def loader_kwargs(config):
+    """
+    DataLoader arguments from config.yaml, the HDF5/shard readers open their files lazily
+    in each worker so any num_workers is fork-safe
+    """
+    kwargs = {
+        'num_workers': config['num_workers'],
+        'pin_memory': config['pin_memory'],
+        'worker_init_fn': seed_worker
+    }
+    if config['num_workers'] > 0:
+        kwargs['persistent_workers'] = config['persistent_workers']
+        kwargs['prefetch_factor'] = config['prefetch_factor']
+    return kwargs
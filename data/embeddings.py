@@ -0,0 +1,51 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+
+def checkpoint_hash(model_path, chunk_size=1 << 20):
+    # embeddings are only valid for the exact weights they were encoded with
+    digest = hashlib.sha1()
+    with open(model_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+def embedding_key(rows, **params):
+    # the frames of the split (dataset rows) and everything that changes the encoder input or precision
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode())
+    digest.update(np.ascontiguousarray(rows, dtype=np.int64).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def load_embeddings(cache_path, model_hash, key, num_frames, encode):
+    """
+    Memory-maps the embeddings of num_frames frames from cache_path/model_hash/key.npy,
+    encoding and storing them on the first call
+
+    Args:
+        encode: callable yielding [n, z_dim] float32 embeddings of consecutive frames
+    Returns:
+        np.memmap: [num_frames, z_dim] embeddings in frame order
+    """
+    path = os.path.join(cache_path, model_hash, key + '.npy')
+    if os.path.exists(path):
+        return np.load(path, mmap_mode='r')
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    out = None
+    start = 0
+    for z in encode():
+        if out is None:
+            out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(num_frames, z.shape[1]))
+        out[start:start + len(z)] = z
+        start += len(z)
+    assert start == num_frames
+    out.flush()
+    del out
+    os.replace(tmp_path, path)
+
+    return np.load(path, mmap_mode='r')
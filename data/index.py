@@ -0,0 +1,105 @@
+import os
+import h5py
+import numpy as np
+
+HDF5_NAME = "GOLD_XYZ_OSC.0001_1024.hdf5"
+FRAMES_PER_BLOCK = 4096  # each modulation-snr has 4096 I/Q samples
+
+_loaded = dict()
+
+
+class RowIndex:
+    def __init__(self, label, snr, pos):
+        """
+        Args:
+            label (np.ndarray): modulation id of every row (argmax of the one-hot 'Y')
+            snr (np.ndarray): SNR of every row ('Z')
+            pos (np.ndarray): position of every row within its modulation-snr block
+        """
+        self.label = label
+        self.snr = snr
+        self.pos = pos
+
+    def __len__(self):
+        return len(self.label)
+
+    def mask(self, class_indices, snr_range=None, split=None, num_sample=FRAMES_PER_BLOCK):
+        """
+        split: 'train' keeps the first num_sample frames of each modulation-snr block,
+               'test' keeps the last num_sample frames, None keeps the whole block
+        """
+        mask = np.isin(self.label, class_indices)
+        if snr_range is not None:
+            mask &= (snr_range[0] <= self.snr) & (self.snr <= snr_range[1])
+
+        assert split in [None, 'train', 'test']
+        if split == 'train':
+            mask &= self.pos < num_sample
+        elif split == 'test':
+            mask &= self.pos >= FRAMES_PER_BLOCK - num_sample
+
+        return mask
+
+    def select(self, class_indices, snr_range=None, split=None, num_sample=FRAMES_PER_BLOCK):
+        # sorted int64 row indices into the HDF5 file
+        return np.flatnonzero(self.mask(class_indices, snr_range, split, num_sample)).astype(np.int64)
+
+
+def build_index(h5_path, chunk_rows=65536):
+    with h5py.File(h5_path, 'r') as f:
+        onehot = f['Y']
+        num_rows = onehot.shape[0]
+
+        label = np.empty(num_rows, dtype=np.int16)
+        for start in range(0, num_rows, chunk_rows):
+            label[start:start + chunk_rows] = np.argmax(onehot[start:start + chunk_rows], axis=1)
+        snr = np.squeeze(f['Z'][:], axis=1).astype(np.int16)
+
+    # a new block starts wherever the modulation or the snr changes
+    new_block = np.ones(num_rows, dtype=bool)
+    new_block[1:] = (label[1:] != label[:-1]) | (snr[1:] != snr[:-1])
+    starts = np.flatnonzero(new_block)
+    lengths = np.diff(np.append(starts, num_rows))
+    pos = np.arange(num_rows) - np.repeat(starts, lengths)
+
+    return RowIndex(label, snr, pos.astype(np.int16))
+
+
+def index_path(root_path, file_name=HDF5_NAME):
+    return os.path.join(root_path, os.path.splitext(file_name)[0] + '.index.npz')
+
+
+def load_index(root_path, file_name=HDF5_NAME):
+    """
+    Loads the label/snr/position index of the RadioML HDF5 file from its sidecar,
+    rebuilding the sidecar when it is missing or the HDF5 size/mtime changed
+    """
+    h5_path = os.path.join(root_path, file_name)
+    sidecar = index_path(root_path, file_name)
+    stat = os.stat(h5_path)
+    key = (sidecar, stat.st_size, stat.st_mtime_ns)
+
+    if key in _loaded:
+        return _loaded[key]
+
+    index = None
+    if os.path.exists(sidecar):
+        with np.load(sidecar) as cached:
+            if int(cached['src_size']) == stat.st_size and int(cached['src_mtime_ns']) == stat.st_mtime_ns:
+                index = RowIndex(cached['label'], cached['snr'], cached['pos'])
+
+    if index is None:
+        print(f'Building row index of {h5_path}')
+        index = build_index(h5_path)
+        try:
+            tmp_path = sidecar + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, label=index.label, snr=index.snr, pos=index.pos,
+                         src_size=stat.st_size, src_mtime_ns=stat.st_mtime_ns)
+            os.replace(tmp_path, sidecar)
+        except OSError:
+            # read-only dataset directory, keep the in-memory index only
+            pass
+
+    _loaded[key] = index
+    return index
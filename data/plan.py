@@ -0,0 +1,64 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+
+def make_episode_plan(labels, num_support, num_query, num_episode, seed, chunk_episodes=256):
+    """
+    Precomputes the frames of num_episode episodes
+
+    Args:
+        labels (np.ndarray): [N] modulation id of every frame of the split
+        num_support (int): support frames per class
+        num_query (int): query frames per class
+    Returns:
+        np.ndarray: [num_episode, n_way, num_support + num_query] int32 positions into labels,
+                    ways in np.unique(labels) order, support first
+    """
+    labels = np.asarray(labels)
+    classes = np.unique(labels)
+    num_shot = num_support + num_query
+    rng = np.random.default_rng(seed)
+
+    plan = np.empty((num_episode, len(classes), num_shot), dtype=np.int32)
+    for way, label in enumerate(classes):
+        indices = np.flatnonzero(labels == label)
+        assert len(indices) >= num_shot
+        for start in range(0, num_episode, chunk_episodes):
+            stop = min(start + chunk_episodes, num_episode)
+            # the num_shot smallest uniform keys are a draw without replacement, ordered by key
+            keys = rng.random((stop - start, len(indices)), dtype=np.float32)
+            picks = np.argpartition(keys, num_shot - 1, axis=1)[:, :num_shot]
+            picks = np.take_along_axis(picks, np.argsort(np.take_along_axis(keys, picks, axis=1), axis=1), axis=1)
+            plan[start:stop, way] = indices[picks]
+
+    return plan
+
+
+def plan_key(labels, num_support, num_query, num_episode, seed):
+    # a plan only depends on the label layout of the split and the episode settings
+    params = json.dumps({'num_support': num_support, 'num_query': num_query,
+                         'num_episode': num_episode, 'seed': seed}, sort_keys=True)
+    digest = hashlib.sha1(params.encode())
+    digest.update(np.ascontiguousarray(labels, dtype=np.int16).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def load_episode_plan(plan_path, labels, num_support, num_query, num_episode, seed):
+    """
+    Replays the episode plan of the same split and settings from plan_path,
+    generating and storing it on the first call
+    """
+    path = os.path.join(plan_path, plan_key(labels, num_support, num_query, num_episode, seed) + '.npy')
+    if os.path.exists(path):
+        return np.load(path)
+
+    plan = make_episode_plan(labels, num_support, num_query, num_episode, seed)
+    os.makedirs(plan_path, exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, plan)
+    os.replace(tmp_path, path)
+
+    return plan
@@ -0,0 +1,149 @@
+import os
+import h5py
+import numpy as np
+from collections import OrderedDict
+from data.index import HDF5_NAME, load_index
+from data.shards import MANIFEST_NAME, ShardStore, ShardRowReader
+
+GB = 1024 ** 3
+
+
+class H5RowReader:
+    def __init__(self, h5_path, rows, sample_len=None, ram_budget=None, cache_chunks=32, max_read_chunks=64):
+        """
+        Reads the I/Q frames of a split (sorted int64 row indices) on demand
+
+        Args:
+            h5_path (str): path of the RadioML HDF5 file
+            rows (np.ndarray): sorted row indices of the split
+            sample_len (int): only the first sample_len samples of each frame are read, None reads whole frames
+            ram_budget (float): GB of RAM the split may be cached in, None always streams from disk
+            cache_chunks (int): number of HDF5 chunks kept by the streaming LRU cache
+            max_read_chunks (int): upper bound of adjacent chunks merged into one hyperslab read
+        """
+        self.h5_path = h5_path
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.cache_chunks = cache_chunks
+        self.max_read_chunks = max_read_chunks
+
+        with h5py.File(h5_path, 'r') as f:
+            self.sample_len = f['X'].shape[1] if sample_len is None else min(sample_len, f['X'].shape[1])
+            self.frame_shape = (self.sample_len,) + f['X'].shape[2:]
+            self.dtype = f['X'].dtype
+            # contiguous datasets are read in blocks of 256 frames (2MB for 1024 x 2 float32)
+            self.chunk_rows = f['X'].chunks[0] if f['X'].chunks is not None else 256
+
+        # the file is opened lazily by each process, h5py handles must not cross a fork
+        self._file = None
+        self._pid = None
+        self._chunks = OrderedDict()
+        self.cached = None
+        split_bytes = len(self.rows) * int(np.prod(self.frame_shape)) * self.dtype.itemsize
+        if ram_budget is not None and split_bytes <= ram_budget * GB:
+            self.cached = self.read_rows(self.rows)
+
+    @property
+    def iq(self):
+        if self._pid != os.getpid():
+            self._file = h5py.File(self.h5_path, 'r')
+            self._pid = os.getpid()
+            self._chunks = OrderedDict()
+        return self._file['X']
+
+    def __getstate__(self):
+        # spawned workers reopen the file themselves
+        state = self.__dict__.copy()
+        state['_file'] = None
+        state['_pid'] = None
+        state['_chunks'] = OrderedDict()
+        return state
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, item):
+        # item is the position of the frame within the split
+        if self.cached is not None:
+            return self.cached[item]
+        return self._chunk_row(self.rows[item])
+
+    def take(self, items):
+        # frames of several split positions in one coalesced read, in the order of items
+        items = np.asarray(items, dtype=np.int64)
+        if self.cached is not None:
+            return self.cached[items]
+        return self.read_rows(self.rows[items])
+
+    def read_rows(self, rows):
+        """
+        Reads arbitrary file rows sorted and grouped by HDF5 chunk,
+        runs of adjacent chunks are merged into a single hyperslab read
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        out = np.empty((len(rows),) + self.frame_shape, dtype=self.dtype)
+        if len(rows) == 0:
+            return out
+
+        order = np.argsort(rows, kind='stable')
+        sorted_rows = rows[order]
+        chunk_ids = sorted_rows // self.chunk_rows
+
+        # split wherever the next needed chunk is not adjacent or the read grows too long
+        gap = np.ones(len(rows), dtype=bool)
+        gap[1:] = np.diff(chunk_ids) > 1
+        segment = np.cumsum(gap) - 1
+        segment_first_chunk = chunk_ids[gap]
+        part = (chunk_ids - segment_first_chunk[segment]) // self.max_read_chunks
+        new_run = gap.copy()
+        new_run[1:] |= part[1:] != part[:-1]
+        bounds = np.append(np.flatnonzero(new_run), len(rows))
+
+        iq = self.iq
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            lo = sorted_rows[start]
+            hi = sorted_rows[stop - 1] + 1
+            block = iq[lo:hi, :self.sample_len]
+            out[order[start:stop]] = block[sorted_rows[start:stop] - lo]
+
+        return out
+
+    def _chunk_row(self, row):
+        iq = self.iq
+        chunk_id = row // self.chunk_rows
+        chunk = self._chunks.get(chunk_id)
+        if chunk is None:
+            start = chunk_id * self.chunk_rows
+            chunk = iq[start:start + self.chunk_rows, :self.sample_len]
+            self._chunks[chunk_id] = chunk
+            if len(self._chunks) > self.cache_chunks:
+                self._chunks.popitem(last=False)
+        else:
+            self._chunks.move_to_end(chunk_id)
+        return chunk[row - chunk_id * self.chunk_rows]
+
+
+def is_sharded(root_path):
+    return os.path.exists(os.path.join(root_path, MANIFEST_NAME))
+
+
+def open_index(root_path):
+    # dataset_path may point to the RadioML HDF5 directory or to a shard directory from data/convert.py
+    if is_sharded(root_path):
+        return ShardStore(root_path).index()
+    return load_index(root_path)
+
+
+def source_identity(root_path):
+    # size and mtime of the RadioML HDF5 file the frames come from, a shard directory records those of its source
+    if is_sharded(root_path):
+        manifest = ShardStore(root_path).manifest
+        return manifest['src_size'], manifest['src_mtime_ns']
+    stat = os.stat(os.path.join(root_path, HDF5_NAME))
+    return stat.st_size, stat.st_mtime_ns
+
+
+def open_reader(root_path, rows, sample_len=None, ram_budget=None):
+    # with sample_len, reads are limited to the first sample_len samples of each frame
+    if is_sharded(root_path):
+        return ShardRowReader(root_path, rows, sample_len=sample_len)
+    return H5RowReader(os.path.join(root_path, HDF5_NAME), rows, sample_len=sample_len, ram_budget=ram_budget)
@@ -0,0 +1,99 @@
+import numpy as np
+import torch
+from data.transform import pad_frames
+
+
+class DeviceEpisodeSampler:
+    def __init__(self, frames, labels, num_support, num_query, device, num_episode=None, pin_memory=False, seed=0,
+                 plan=None):
+        """
+        Holds a test split as one tensor on the target device and draws episodes there
+        with index gathers, replacing the DataLoader in meta_test
+
+        Args:
+            frames: [N, I/Q, data_length] frames of the split, already padded to the encoder frame length
+            labels (np.ndarray): [N] modulation id of every frame
+            num_support (int): support frames per class
+            num_query (int): query frames per class
+            device: device the frames and the episode indices live on
+            num_episode (int): episodes per iteration, defaults to as many as FewShotDataset has
+            pin_memory (bool): stage the host copy in pinned memory before the transfer
+            seed (int): seed of the device generator
+            plan (np.ndarray): [num_episode, n_way, num_support + num_query] episode plan replayed instead
+                               of drawing episodes, positions index frames
+        """
+        self.device = torch.device(device)
+        self.num_support = num_support
+        self.num_query = num_query
+
+        frames = torch.as_tensor(frames)
+        if pin_memory and self.device.type == 'cuda' and frames.device.type == 'cpu':
+            frames = frames.pin_memory()
+        self.frames = frames.to(self.device, non_blocking=True)
+
+        # [n_way, max class size] positions of every class, short classes are padded and masked out
+        labels = np.asarray(labels)
+        classes = np.unique(labels)
+        label_indices = [np.flatnonzero(labels == label) for label in classes]
+        counts = [len(indices) for indices in label_indices]
+        assert min(counts) >= num_support + num_query
+        table = np.zeros((len(classes), max(counts)), dtype=np.int64)
+        for i, indices in enumerate(label_indices):
+            table[i, :counts[i]] = indices
+        self.table = torch.from_numpy(table).to(self.device)
+        self.valid = torch.arange(max(counts), device=self.device) < torch.tensor(counts, device=self.device)[:, None]
+
+        n_way = len(classes)
+        if num_episode is None:
+            num_episode = len(labels) // ((num_support + num_query) * n_way) if plan is None else len(plan)
+        self.num_episode = num_episode
+        self.plan = None if plan is None else torch.from_numpy(plan.astype(np.int64)).to(self.device)
+        self.label = torch.from_numpy(classes.astype(np.int64)).to(self.device).unsqueeze(0)
+        self.target = torch.arange(n_way, device=self.device).view(1, n_way, 1).expand(1, n_way, num_query)
+        self.generator = torch.Generator(device=self.device).manual_seed(seed)
+
+    @classmethod
+    def from_dataset(cls, dataset, device, num_episode=None, pin_memory=False, seed=0):
+        # [N, I/Q, data_length] frames of a FewShotDataset, padded exactly like its DataLoader episodes
+        frames = dataset.iq.take(np.arange(len(dataset.iq)))
+        frames = torch.from_numpy(np.ascontiguousarray(frames[:, :dataset.test_sample_len].transpose(0, 2, 1)))
+        if dataset.mode == 'test':
+            frames = pad_frames(frames, dataset.train_sample_len, dataset.padding)
+
+        return cls(frames, dataset.label_list, dataset.num_support, dataset.num_query, device,
+                   num_episode=num_episode, pin_memory=pin_memory, seed=seed, plan=dataset.load_plan())
+
+    def __len__(self):
+        return self.num_episode
+
+    def sample(self, episode=None):
+        if self.plan is not None:
+            return self.gather(self.plan[episode])
+
+        return self.gather(self.draw())
+
+    def draw(self):
+        # k + q distinct frames per class: top-k of uniform keys is a uniform draw without replacement
+        keys = torch.rand(self.table.shape, generator=self.generator, device=self.device)
+        keys = keys.masked_fill(~self.valid, -1.0)
+        picks = keys.topk(self.num_support + self.num_query, dim=1).indices
+        return self.table.gather(1, picks)
+
+    def positions(self):
+        # [num_episode, n_way, num_support + num_query] frames of every episode, the same draws as iterating
+        if self.plan is not None:
+            return self.plan[:self.num_episode]
+        return torch.stack([self.draw() for _ in range(self.num_episode)])
+
+    def gather(self, positions):
+        frames = self.frames[positions]  # [n_way, num_shot, I/Q, data_length]
+        return {
+            'support': frames[:, :self.num_support].unsqueeze(0),
+            'query': frames[:, self.num_support:].unsqueeze(0),
+            'target': self.target,
+            'label': self.label
+        }
+
+    def __iter__(self):
+        for episode in range(self.num_episode):
+            yield self.sample(episode)
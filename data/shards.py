@@ -0,0 +1,96 @@
+import os
+import json
+import numpy as np
+from data.index import RowIndex
+
+MANIFEST_NAME = "manifest.json"
+
+
+def shard_name(label, snr):
+    return f"{label:02d}_{snr:+03d}.npy"
+
+
+class ShardStore:
+    def __init__(self, root_path):
+        """
+        Per-(modulation, snr) .npy shards written by data/convert.py, opened as np.memmap
+
+        Rows are numbered as in the source HDF5 file, so the row indices of RowIndex.select
+        address the same frames in both formats
+        """
+        self.root_path = root_path
+        self.manifest = json.load(open(os.path.join(root_path, MANIFEST_NAME), 'r'))
+        self.blocks = self.manifest['blocks']
+
+        lengths = np.array([block['num_frames'] for block in self.blocks], dtype=np.int64)
+        self.block_starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        self._memmaps = dict()
+
+    def __getstate__(self):
+        # memmaps would be pickled as full arrays, spawned workers map the shards again
+        state = self.__dict__.copy()
+        state['_memmaps'] = dict()
+        return state
+
+    def __len__(self):
+        return int(sum(block['num_frames'] for block in self.blocks))
+
+    def index(self):
+        labels = [block['label'] for block in self.blocks]
+        snrs = [block['snr'] for block in self.blocks]
+        lengths = [block['num_frames'] for block in self.blocks]
+        pos = np.concatenate([np.arange(length) for length in lengths])
+        return RowIndex(np.repeat(labels, lengths).astype(np.int16),
+                        np.repeat(snrs, lengths).astype(np.int16),
+                        pos.astype(np.int16))
+
+    def shard(self, block_id):
+        if block_id not in self._memmaps:
+            path = os.path.join(self.root_path, self.blocks[block_id]['file'])
+            self._memmaps[block_id] = np.load(path, mmap_mode='r')
+        return self._memmaps[block_id]
+
+    def read_rows(self, rows, sample_len=None):
+        # only the first sample_len samples of each frame are paged in
+        rows = np.asarray(rows, dtype=np.int64)
+        block_of_row = np.searchsorted(self.block_starts, rows, side='right') - 1
+
+        out = None
+        for block_id in np.unique(block_of_row):
+            positions = np.flatnonzero(block_of_row == block_id)
+            shard = self.shard(int(block_id))[:, :sample_len]
+            if out is None:
+                out = np.empty((len(rows),) + shard.shape[1:], dtype=shard.dtype)
+            out[positions] = shard[rows[positions] - self.block_starts[block_id]]
+
+        if out is None:
+            frame_shape = tuple(self.manifest['frame_shape'])
+            frame_shape = (frame_shape[0] if sample_len is None else min(sample_len, frame_shape[0]),) + frame_shape[1:]
+            out = np.empty((0,) + frame_shape, dtype=self.manifest['dtype'])
+        return out
+
+
+class ShardRowReader:
+    def __init__(self, root_path, rows, sample_len=None):
+        """
+        Same interface as H5RowReader, frames come straight from the page cache,
+        so there is no separate RAM budget and worker processes share the pages
+        """
+        self.store = ShardStore(root_path)
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.sample_len = sample_len
+        self.cached = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, item):
+        row = self.rows[item]
+        block_id = int(np.searchsorted(self.store.block_starts, row, side='right') - 1)
+        return self.store.shard(block_id)[row - self.store.block_starts[block_id], :self.sample_len]
+
+    def take(self, items):
+        return self.read_rows(self.rows[np.asarray(items, dtype=np.int64)])
+
+    def read_rows(self, rows):
+        return self.store.read_rows(rows, self.sample_len)
@@ -0,0 +1,104 @@
+import os
+import socket
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def as_iq(chunk):
+    # [n, I/Q] float32 samples of a complex or [n, 2] real chunk
+    chunk = np.asarray(chunk)
+    if np.iscomplexobj(chunk):
+        return np.stack([chunk.real, chunk.imag], axis=1).astype(np.float32)
+    return chunk.reshape(-1, 2).astype(np.float32, copy=False)
+
+
+def file_chunks(path, chunk_samples):
+    """
+    Memory-maps a recording and yields it chunk by chunk:
+    .npy holds [N, 2] or complex samples, .bin raw interleaved float32 I/Q (complex64)
+    """
+    if path.endswith('.npy'):
+        samples = np.load(path, mmap_mode='r')
+    else:
+        samples = np.memmap(path, dtype=np.float32, mode='r')
+        samples = samples[:len(samples) // 2 * 2].reshape(-1, 2)
+    for start in range(0, len(samples), chunk_samples):
+        yield as_iq(samples[start:start + chunk_samples])
+
+
+def socket_chunks(address, chunk_samples):
+    # interleaved float32 I/Q from a tcp://host:port server until it closes the connection
+    host, port = address[len('tcp://'):].rsplit(':', 1)
+    sample_bytes = 2 * np.dtype(np.float32).itemsize
+    with socket.create_connection((host, int(port))) as conn:
+        pending = b''
+        while True:
+            data = conn.recv(chunk_samples * sample_bytes)
+            if not data:
+                break
+            # a sample split across two reads waits for its second half
+            pending += data
+            usable = len(pending) // sample_bytes * sample_bytes
+            if usable:
+                yield np.frombuffer(pending[:usable], dtype=np.float32).reshape(-1, 2)
+                pending = pending[usable:]
+
+
+def open_stream(source, chunk_samples=16384):
+    """
+    Args:
+        source: path of a .npy/.bin recording, tcp://host:port, or any iterable of sample chunks
+    Returns:
+        iterator of [n, I/Q] float32 chunks
+    """
+    if isinstance(source, str):
+        if source.startswith('tcp://'):
+            return socket_chunks(source, chunk_samples)
+        if not os.path.exists(source):
+            raise FileNotFoundError(source)
+        return file_chunks(source, chunk_samples)
+    return (as_iq(chunk) for chunk in source)
+
+
+class SlidingWindows:
+    def __init__(self, window, hop):
+        """
+        Cuts overlapping windows of an unbounded sample stream, windows are strided views
+        of the buffered samples, only the tail shorter than a window is carried to the next chunk
+
+        Args:
+            window (int): samples per window (frame length of the encoder)
+            hop (int): samples between the starts of consecutive windows
+        """
+        self.window = window
+        self.hop = hop
+        self.buffer = np.zeros((0, 2), dtype=np.float32)
+        self.start = 0  # stream position of buffer[0]
+        self.skip = 0  # samples still to drop between two windows when hop > window
+
+    def push(self, chunk):
+        """
+        Returns:
+            windows: [num_window, I/Q, window] view of the windows completed by chunk
+            starts: [num_window] stream position of the first sample of every window
+        """
+        buffer = np.concatenate([self.buffer, chunk]) if len(self.buffer) else chunk
+        if self.skip:
+            drop = min(self.skip, len(buffer))
+            buffer = buffer[drop:]
+            self.start += drop
+            self.skip -= drop
+        if len(buffer) < self.window:
+            self.buffer = buffer
+            return np.zeros((0, 2, self.window), dtype=np.float32), np.zeros(0, dtype=np.int64)
+        num_window = (len(buffer) - self.window) // self.hop + 1
+
+        # sliding_window_view puts the window axis last, which is the [I/Q, data_length] frame layout
+        windows = sliding_window_view(buffer, self.window, axis=0)[::self.hop]
+        starts = self.start + self.hop * np.arange(num_window)
+
+        consumed = min(num_window * self.hop, len(buffer))
+        self.skip = num_window * self.hop - consumed
+        self.buffer = buffer[consumed:]
+        self.start += consumed
+        return windows, starts
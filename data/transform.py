@@ -1,12 +1,43 @@
 import torch
-from torchvision import transforms
+import torch.nn.functional as F
 
-class AMCTransform(object):
-    def __init__(self):
-        super().__init__()
-        self.transform = transforms.Compose([transforms.ToTensor()])
+# sudo apt-key adv --keyserver keyserver.ubuntu.com --recv-keys F60F4B3D7FA2AF80
 
-    def __call__(self, signal):
-        return self.transform(signal)
 
-# sudo apt-key adv --keyserver keyserver.ubuntu.com --recv-keys F60F4B3D7FA2AF80
\ No newline at end of file
+def pad_frames(x, frame_len, padding='self_duplicate'):
+    """
+    Extends a batch of short frames to the frame length the encoder was trained with
+    x: [..., I/Q, sample_len]
+    Returns [..., I/Q, frame_len // sample_len * sample_len] for self_duplicate, [..., I/Q, frame_len] for zero
+    and x itself for none (encoders taking any frame length)
+    """
+    sample_len = x.shape[-1]
+    if sample_len == frame_len or padding == 'none':
+        return x
+    if padding == 'self_duplicate':
+        return x.repeat(*([1] * (x.dim() - 1)), frame_len // sample_len)
+    elif padding == 'zero':
+        return F.pad(x, (0, frame_len - sample_len))
+    raise NotImplementedError(padding)
+
+
+def reverse_concat(x):
+    """
+    Robust CNN input: each frame stacked with its time-reversed copy
+    x: [N, I/Q, data_length]
+    Returns [N, 1, 2 * I/Q, data_length]
+    """
+    return torch.cat((x, x.flip(-1)), dim=-2).unsqueeze(1)
+
+
+def supervised_input(x, model, robust=False):
+    """
+    Batched input layout of the supervised models
+    x: [N, I/Q, data_length]
+    Returns [N, 1, 2 * I/Q, data_length] (robust), [N, data_length, I/Q] (daelstm) or [N, I/Q, 1, data_length]
+    """
+    if robust:
+        return reverse_concat(x)
+    if model.startswith('daelstm'):
+        return x.transpose(1, 2)
+    return x.unsqueeze(2)
@@ -2,6 +2,7 @@ import logging
 import argparse
 from runner.train import Trainer
 from runner.test import Tester
+from runner.stream import Streamer
 from runner.utils import CustomFormatter, get_config
 from datetime import datetime
 
@@ -14,7 +15,10 @@ if __name__ == '__main__':
     logger.addHandler(handler)
 
     parser = argparse.ArgumentParser(description='Process some integers.')
-    parser.add_argument('mode', type=str, default='all', help='train: only train, test: only test, all: train+test')
+    parser.add_argument('mode', type=str, default='all', help='train: only train, test: only test, all: train+test, '
+                                                              'quantize: save the dynamic INT8 checkpoint, '
+                                                              'prototypes: add classes to the prototype store, '
+                                                              'stream: classify the I/Q stream of stream_source')
 
     args = parser.parse_args()
 
@@ -22,7 +26,7 @@ if __name__ == '__main__':
     model_params = get_config('./config/model_params.yaml')[config['model']]
     lr_mode = model_params['lr_mode']
 
-    assert args.mode in ['train', 'test', 'all']
+    assert args.mode in ['train', 'test', 'all', 'quantize', 'prototypes', 'stream']
 
     def run_training(trainer, tester):
         if args.mode in ['train', 'all']:
@@ -33,7 +37,19 @@ if __name__ == '__main__':
             logger.info('Test')
             tester.test() if lr_mode == 'supervised' else tester.meta_test()
 
-    trainer = Trainer(config, model_params)
-    tester = Tester(config, model_params, per_snr=(lr_mode == 'supervised'))
-    run_training(trainer, tester)
+        if args.mode == 'quantize':
+            logger.info('Dynamic INT8 quantization')
+            tester.quantize()
+
+        if args.mode == 'prototypes':
+            logger.info('Prototype store')
+            tester.build_prototypes()
+
+    if args.mode == 'stream':
+        logger.info('Streaming classification')
+        Streamer(config, model_params).stream()
+    else:
+        trainer = Trainer(config, model_params)
+        tester = Tester(config, model_params, per_snr=(lr_mode == 'supervised'))
+        run_training(trainer, tester)
 
@@ -1,6 +1,5 @@
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
 import torch.nn.functional as F
 import numpy as np
 from models.robustcnn import *
@@ -8,6 +7,7 @@ from models.vit import *
 from models.protonet import *
 from models.daelstm import *
 from models.resnet import *
+from runner.utils import get_device, memory_format
 
 
 class ProtoNet(nn.Module):
@@ -20,157 +20,322 @@ class ProtoNet(nn.Module):
             n_query (int): number of labeled examples per class in the query set
         """
         super(ProtoNet, self).__init__()
-        self.encoder = encoder.cuda(0)
         self.config = config
+        self.device = get_device(config)
+        self.memory_format = memory_format(config, self.device)
+        self.encoder = encoder.to(self.device, memory_format=self.memory_format)
+
+        # ViT exits: 1-based block counts whose class token embedding can end the forward, the last is the full encoder
+        self.exit_layers = None
+        if isinstance(encoder, ViT):
+            depth = len(encoder.blocks)
+            self.exit_layers = [layer for layer in config['exit_layers'] if layer < depth] + [depth]
+            self.exit_thresholds = config['exit_thresholds'][:len(self.exit_layers) - 1]
+        elif config['early_exit']:
+            raise ValueError(f"early_exit needs a ViT encoder (vit_main, vit_sub), got {config['model']}")
+
+    def encoder_input(self, x):
+        """
+        x: [N, I/Q, data_length] frames
+        Returns the frames in the input layout of the encoder
+        """
+        if self.config['model'] == 'resnet':
+            return x.reshape((-1, 2, 1, x.shape[-1]))
+        if self.config['model'].startswith('daelstm'):
+            return x.permute(0, 2, 1)
+        return x.unsqueeze(1)
+
+    def frames_input(self, x):
+        # encoder input of [N, I/Q, data_length] frames on the model device
+        x = self.encoder_input(x).to(self.device, non_blocking=True)
+        if x.dim() == 4:
+            x = x.contiguous(memory_format=self.memory_format)
+        return x
+
+    def unpack_episode(self, sample, query=True):
+        """
+        support shape: [num_episode, K_way, num_support, I/Q, data_length]
+        query shape: [num_episode, K_way, num_query, I/Q, data_length]
+        Returns the encoder input of the support set followed by the query set of all episodes,
+        stacked episode by episode and way by way
+        """
+        x_support = sample['support']
+        n_episode, n_way, n_support = x_support.shape[:3]
+        x = x_support.reshape(-1, *x_support.shape[3:])
 
-    def proto_train(self, sample):
-        n_way = len(sample.keys())
-        n_support = self.config['num_support']
-        n_query = self.config['num_query']
+        n_query = 0
+        if query:
+            x_query = sample['query']
+            n_query = x_query.shape[2]
+            x = torch.cat((x, x_query.reshape(-1, *x_query.shape[3:])))
+
+        return self.frames_input(x), n_episode, n_way, n_support, n_query
 
+    def encode_episode(self, sample, query=True):
         """
-        support shape: [K_way, num_support, 1, I/Q, data_length]
-        query shape: [K_way, num_query, 1, I/Q, data_length]
+        Encodes the support and the query set in a single encoder forward
+        Returns z_support: [num_episode * K_way * num_support, z_dim], z_query (None without query) and the episode sizes
         """
-        x_support = None
-        x_query = None
-        for label in sample.keys():
-            if x_support is None:
-                x_support = np.array([np.array(iq) for iq in sample[label]['support']])
-            else:
-                x_support = np.vstack([x_support, np.array([np.array(iq) for iq in sample[label]['support']])])
-            if x_query is None:
-                x_query = np.array([np.array(iq) for iq in sample[label]['query']])
-            else:
-                x_query = np.vstack([x_query, np.array([np.array(iq) for iq in sample[label]['query']])])
+        x, n_episode, n_way, n_support, n_query = self.unpack_episode(sample, query)
 
-        x_support = torch.from_numpy(x_support).cuda(0)
-        x_query = torch.from_numpy(x_query).cuda(0)
+        z = self.encoder.forward(x)
+        num_support = n_episode * n_way * n_support
+        z_support = z[:num_support]
+        z_query = z[num_support:] if query else None
 
-        if self.config['model'] == 'resnet':
-            x_support = x_support.reshape((-1,2,1,x_support.shape[-1]))
-            x_query = x_query.reshape((-1,2,1,x_query.shape[-1]))
+        return z_support, z_query, n_episode, n_way, n_support, n_query
+
+    def episode_log_p_y(self, z_support, z_query, n_episode, n_way, n_support, n_query):
+        """
+        Prototypes, distances and log-probabilities of every episode at once
+        Returns log_p_y: [num_episode, K_way, num_query, K_way]
+        """
+        # embeddings of an autocast forward are averaged and compared in fp32
+        with torch.autocast(self.device.type, enabled=False):
+            z_support, z_query = z_support.float(), z_query.float()
+            z_dim = z_support.size(-1)
+            z_proto = z_support.view(n_episode, n_way, n_support, z_dim).mean(2)
+
+            # compute distances
+            dists = torch.cdist(z_query.view(n_episode, n_way * n_query, z_dim), z_proto)
+
+            # compute probabilities
+            return F.log_softmax(-dists, dim=2).view(n_episode, n_way, n_query, n_way)
+
+    def episode_accuracy(self, z, support, query, chunk_episodes=1024):
+        """
+        Accuracy of every episode on precomputed embeddings, chunk_episodes episodes at a time
+
+        Args:
+            z: [N, z_dim] embeddings of the split
+            support: [num_episode, K_way, num_support] positions into z
+            query: [num_episode, K_way, num_query] positions into z
+        Returns:
+            torch.Tensor: [num_episode] accuracy
+        """
+        n_episode, n_way, n_support = support.shape
+        n_query = query.size(2)
+        z_dim = z.size(1)
+
+        acc = []
+        for start in range(0, n_episode, chunk_episodes):
+            z_support = z[support[start:start + chunk_episodes]].reshape(-1, z_dim)
+            z_query = z[query[start:start + chunk_episodes]].reshape(-1, z_dim)
+            n_chunk = min(chunk_episodes, n_episode - start)
+
+            log_p_y = self.episode_log_p_y(z_support, z_query, n_chunk, n_way, n_support, n_query)
+            target_inds = self.target_inds(n_chunk, n_way, n_query).squeeze(3)
+            acc.append(torch.eq(log_p_y.argmax(3), target_inds).float().mean((1, 2)))
+
+        return torch.cat(acc)
 
+    def target_inds(self, n_episode, n_way, n_query):
         # target indices are 0 ... n_way-1
-        target_inds = torch.arange(0, n_way).view(n_way, 1, 1).expand(n_way, n_query, 1).long()
-        target_inds = Variable(target_inds, requires_grad=False)
-        target_inds = target_inds.cuda(0)
-        
-        if self.config['model'] in ['lstm', 'daelstm']:
-            x_support = x_support.squeeze().permute(0, 2, 1)
-            x_query = x_query.squeeze().permute(0, 2, 1)
+        target_inds = torch.arange(0, n_way).view(1, n_way, 1, 1).expand(n_episode, n_way, n_query, 1).long()
+        return target_inds.to(self.device)
 
+    def proto_train(self, sample):
         # encode dataloader dataframes of the support and the query set
-        z_support = self.encoder.forward(x_support)
-        z_query = self.encoder.forward(x_query)
-        z_support_dim = z_support.size(-1)
-        z_proto = z_support.view(n_way, n_support, z_support_dim).mean(1)
+        z_support, z_query, n_episode, n_way, n_support, n_query = self.encode_episode(sample)
+        target_inds = self.target_inds(n_episode, n_way, n_query)
 
-        # compute distances
-        dists = torch.cdist(z_query, z_proto)
+        log_p_y = self.episode_log_p_y(z_support, z_query, n_episode, n_way, n_support, n_query)
 
-        # compute probabilities
-        log_p_y = F.log_softmax(-dists, dim=1).view(n_way, n_query, -1)
-
-        loss_val = -log_p_y.gather(2, target_inds).squeeze().view(-1).mean()
-        _, y_hat = log_p_y.max(2)
-        acc_val = torch.eq(y_hat, target_inds.squeeze()).float().mean()
+        # episodes have the same size, so the mean averages the loss (and the gradients) over episodes
+        loss_val = -log_p_y.gather(3, target_inds).mean()
+        _, y_hat = log_p_y.max(3)
+        acc_val = torch.eq(y_hat, target_inds.squeeze(3)).float().mean()
 
         return loss_val, {
             'loss': loss_val.item(),
             'acc': acc_val.item(),
-            'y_hat': y_hat
+            'y_hat': y_hat.squeeze(0)
         }
 
-    def create_protoNet(self, sample):
-        n_way = len(sample.keys())
-        n_support = self.config['num_support']
+    def create_protoNet(self, sample, taps=False):
+        # encode dataloader dataframes of the support set
+        if taps:
+            # [num_exit, K_way, z_dim] prototypes of every exit layer, for early-exit classify
+            x, n_episode, n_way, n_support, _ = self.unpack_episode(sample, query=False)
+            z_support = self.encoder.forward_taps(x, self.exit_layers).float()
+            return z_support.view(len(self.exit_layers), n_episode, n_way, n_support, -1).mean(3).squeeze(1)
 
-        """
-        support shape: [K_way, num_support, 1, I/Q, data_length]
-        query shape: [K_way, num_query, 1, I/Q, data_length]
-        """
-        x_support = None
-        x_query = None
-        for label in sample.keys():
-            if x_support is None:
-                x_support = np.array([np.array(iq) for iq in sample[label]['support']])
-            else:
-                x_support = np.vstack([x_support, np.array([np.array(iq) for iq in sample[label]['support']])])
-            if x_query is None:
-                x_query = np.array([np.array(iq) for iq in sample[label]['query']])
-            else:
-                x_query = np.vstack([x_query, np.array([np.array(iq) for iq in sample[label]['query']])])
+        z_support, _, n_episode, n_way, n_support, _ = self.encode_episode(sample, query=False)
+        z_support = z_support.float()
+        z_support_dim = z_support.size(-1)
+        z_proto = z_support.view(n_episode, n_way, n_support, z_support_dim).mean(2)
+
+        return z_proto.squeeze(0)
 
-        x_support = torch.from_numpy(x_support).cuda(0)
+
+    def proto_test(self, sample):
+        if self.config['early_exit']:
+            return self.proto_test_early_exit(sample)
 
         # encode dataloader dataframes of the support and the query set
-        z_support = self.encoder.forward(x_support)
-        z_support_dim = z_support.size(-1)
-        z_proto = z_support.view(n_way, n_support, z_support_dim).mean(1)
+        z_support, z_query, n_episode, n_way, n_support, n_query = self.encode_episode(sample)
+        target_inds = self.target_inds(n_episode, n_way, n_query)
 
-        return z_proto
+        log_p_y = self.episode_log_p_y(z_support, z_query, n_episode, n_way, n_support, n_query)
 
+        _, y_hat = log_p_y.max(3)
+        acc_val = torch.eq(y_hat, target_inds.squeeze(3)).float().mean()  # y_hat과 gt 같은지 비교
 
-    def proto_test(self, sample):
-        n_way = len(sample.keys())
-        n_support = self.config['num_support']
-        n_query = self.config['num_query']
+        return {
+            'acc': acc_val.item(),
+            'y_hat': y_hat.squeeze(0)
+        }
 
+
+    def early_exit(self, x, z_protos, episode):
         """
-        support shape: [K_way, num_support, 1, I/Q, data_length]
-        query shape: [K_way, num_query, 1, I/Q, data_length]
+        Runs the encoder input x of query frames exit layer by exit layer, every frame stops at the first
+        exit whose prototype probability reaches its threshold and the last exit takes the rest
+        z_protos: [num_exit, num_episode, K_way, z_dim] prototypes of every exit
+        episode: [N] episode of every frame
+        Returns y_hat: [N] and the exit layer every frame left at: [N]
         """
-        x_support = None
-        x_query = None
-        for label in sample.keys():
-            if x_support is None:
-                x_support = np.array([np.array(iq) for iq in sample[label]['support']])
-            else:
-                x_support = np.vstack([x_support, np.array([np.array(iq) for iq in sample[label]['support']])])
-            if x_query is None:
-                x_query = np.array([np.array(iq) for iq in sample[label]['query']])
+        y_hat = torch.empty(len(x), dtype=torch.long, device=self.device)
+        exit_layer = torch.empty_like(y_hat)
+        active = torch.arange(len(x), device=self.device)
+
+        x = self.encoder.tokens(x)
+        depth = 0
+        for tap, layer in enumerate(self.exit_layers):
+            x = self.encoder.blocks[depth:layer](x)
+            depth = layer
+            z = self.encoder.head(x)
+
+            with torch.autocast(self.device.type, enabled=False):
+                dists = torch.cdist(z.float().unsqueeze(1), z_protos[tap][episode[active]]).squeeze(1)
+                p_y, pred = F.softmax(-dists, dim=1).max(1)
+
+            if tap == len(self.exit_layers) - 1:
+                done = torch.ones_like(pred, dtype=torch.bool)
             else:
-                x_query = np.vstack([x_query, np.array([np.array(iq) for iq in sample[label]['query']])])
+                done = p_y >= self.exit_thresholds[tap]
+            y_hat[active[done]] = pred[done]
+            exit_layer[active[done]] = layer
 
-        x_support = torch.from_numpy(x_support).cuda(0)
-        x_query = torch.from_numpy(x_query).cuda(0)
+            active, x = active[~done], x[~done]
+            if not len(active):
+                break
 
-        # target indices are 0 ... n_way-1
-        target_inds = torch.arange(0, n_way).view(n_way, 1, 1).expand(n_way, n_query, 1).long()
-        target_inds = Variable(target_inds, requires_grad=False)
-        target_inds = target_inds.cuda(0)
-
-        if self.config['model'] == 'daelstm':
-            x_support = x_support.squeeze().permute(0, 2, 1)
-            x_query = x_query.squeeze().permute(0, 2, 1)
+        return y_hat, exit_layer
 
-        # encode dataloader dataframes of the support and the query set
-        z_support = self.encoder.forward(x_support)
-        z_query = self.encoder.forward(x_query)
-        z_support_dim = z_support.size(-1)
-        z_proto = z_support.view(n_way, n_support, z_support_dim).mean(1)
+    def proto_test_early_exit(self, sample):
+        # every exit layer has its own prototypes, the support set runs the full encoder
+        x, n_episode, n_way, n_support, _ = self.unpack_episode(sample, query=False)
+        z_support = self.encoder.forward_taps(x, self.exit_layers).float()
+        z_protos = z_support.view(len(self.exit_layers), n_episode, n_way, n_support, -1).mean(3)
 
-        dists = torch.cdist(z_query, z_proto)
+        x_query = sample['query']
+        n_query = x_query.shape[2]
+        x_query = self.frames_input(x_query.reshape(-1, *x_query.shape[3:]))
+        episode = torch.arange(n_episode, device=self.device).repeat_interleave(n_way * n_query)
+        y_hat, exit_layer = self.early_exit(x_query, z_protos, episode)
 
-        # compute probabilities
-        log_p_y = F.log_softmax(-dists, dim=1).view(n_way, n_query, -1)
-        _, y_hat = log_p_y.max(2)
-        loss_val = -log_p_y.gather(2, target_inds).squeeze().view(-1).mean()
-        acc_val = torch.eq(y_hat, target_inds.squeeze()).float().mean()  # y_hat과 gt 같은지 비교
+        y_hat = y_hat.view(n_episode, n_way, n_query)
+        target_inds = self.target_inds(n_episode, n_way, n_query)
+        acc_val = torch.eq(y_hat, target_inds.squeeze(3)).float().mean()
 
         return {
             'acc': acc_val.item(),
-            'y_hat': y_hat
+            'y_hat': y_hat.squeeze(0),
+            'exit_layer': exit_layer.view(n_episode, n_way, n_query).squeeze(0)
         }
 
+    def proto_test_taps(self, sample):
+        """
+        Prototype probabilities of the queries at every exit layer, without stopping early
+        Returns p_y, y_hat: [num_exit, num_episode * K_way * num_query] and target: [num_episode * K_way * num_query]
+        """
+        x, n_episode, n_way, n_support, n_query = self.unpack_episode(sample)
+        z = self.encoder.forward_taps(x, self.exit_layers)
+        num_support = n_episode * n_way * n_support
+
+        log_p_y = torch.stack([self.episode_log_p_y(z_tap[:num_support], z_tap[num_support:],
+                                                    n_episode, n_way, n_support, n_query) for z_tap in z])
+        log_p, y_hat = log_p_y.max(4)
+        target_inds = self.target_inds(n_episode, n_way, n_query)
+
+        return {
+            'p_y': log_p.exp().flatten(1),
+            'y_hat': y_hat.flatten(1),
+            'target': target_inds.flatten()
+        }
+
+    def classify(self, x, z_proto):
+        """
+        Batch classification of frames against the prototypes of create_protoNet
+        x: [N, I/Q, data_length] frames
+        z_proto: [K_way, z_dim], or [num_exit, K_way, z_dim] (create_protoNet(sample, taps=True)) to exit early
+        Returns y_hat: [N] and the exit layer of every frame (None for encoders without exits)
+        """
+        x = self.frames_input(x)
+        if z_proto.dim() == 3:
+            return self.early_exit(x, z_proto.unsqueeze(1), torch.zeros(len(x), dtype=torch.long, device=self.device))
+
+        z = self.encoder.forward(x)
+        with torch.autocast(self.device.type, enabled=False):
+            y_hat = torch.cdist(z.float(), z_proto).argmin(1)
+
+        exit_layer = None if self.exit_layers is None else torch.full_like(y_hat, self.exit_layers[-1])
+        return y_hat, exit_layer
+
+
+class PrototypeIndex:
+    def __init__(self, z_proto, chunk_elements=1 << 24):
+        """
+        Nearest-prototype search over thousands of prototypes: squared L2 distances are one matmul per
+        chunk of queries with the prototype norms precomputed, ||q||^2 + ||p||^2 - 2 q.p
+
+        Args:
+            z_proto: [num_proto, z_dim] prototypes
+            chunk_elements (int): query x prototype distances held at once, bounds the memory of a search
+        """
+        if z_proto is None or len(z_proto) == 0:
+            raise ValueError('no prototypes registered')
+        self.z_proto = z_proto.float()
+        self.proto_norms = self.z_proto.pow(2).sum(1)
+        self.chunk_size = max(1, chunk_elements // len(self.z_proto))
+
+    def __len__(self):
+        return len(self.z_proto)
+
+    def search(self, z, k=1, threshold=None):
+        """
+        Args:
+            z: [N, z_dim] query embeddings
+            threshold (float): squared distance above which the nearest prototype is rejected as unknown
+        Returns:
+            dists: [N, k] squared L2 distances, nearest first
+            indices: [N, k] prototype indices, -1 for every neighbour of a rejected query
+        """
+        z = z.float().to(self.z_proto.device)
+        k = min(k, len(self.z_proto))
+
+        dists, indices = [], []
+        for start in range(0, len(z), self.chunk_size):
+            z_chunk = z[start:start + self.chunk_size]
+            d = torch.addmm(self.proto_norms, z_chunk, self.z_proto.t(), alpha=-2)
+            d = d.add_(z_chunk.pow(2).sum(1, keepdim=True)).clamp_(min=0)
+            d, i = d.min(1, keepdim=True) if k == 1 else d.topk(k, dim=1, largest=False)
+            dists.append(d)
+            indices.append(i)
+
+        dists, indices = torch.cat(dists), torch.cat(indices)
+        if threshold is not None:
+            indices = indices.masked_fill(dists[:, :1] > threshold, -1)
+        return dists, indices
+
 
 class Flatten(nn.Module):
     def __init__(self):
         super(Flatten, self).__init__()
 
     def forward(self, x):
-        return x.view(x.size(0), -1)
+        return x.reshape(x.size(0), -1)
 
 def load_protonet_conv(**kwargs):
     """
@@ -216,15 +381,52 @@ def load_protonet_vit(config, model_params):
         num_heads=model_params["num_heads"],
         mlp_dim=model_params["mlp_dim"],
         num_classes=model_params["num_classes"],
-        in_size=model_params["in_size"]
-
+        in_size=model_params["in_size"],
+        pos_embed_mode=config['pos_embed_mode']
     )
     return ProtoNet(encoder, config)
 
 def load_protonet_daelstm(config):
 
     encoder = DAELSTM(input_shape=[1,2,1024],
-                   modulation_num=config["num_classes"])
+                   modulation_num=len(config["total_class"]))
 
     return ProtoNet(encoder, config)
 
+
+if __name__ == '__main__':
+    import time
+    from runner.utils import euclidean_dist
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    def benchmark(search, repeat=5):
+        search()
+        if device == "cuda":
+            torch.cuda.synchronize()
+        start_time = time.perf_counter()
+        for _ in range(repeat):
+            search()
+        if device == "cuda":
+            torch.cuda.synchronize()
+        return (time.perf_counter() - start_time) / repeat * 1000
+
+    # top-k of 1024 queries against 10^3 - 10^5 prototypes, euclidean_dist expands [N, M, D] so it stops at 10^4
+    z_dim, num_query = 36, 1024
+    print("prototypes | k | index ms | cdist ms | euclidean_dist ms | top-k agreement")
+    for num_proto, k in [(n, k) for n in [1000, 10000, 100000] for k in [1, 5]]:
+        z_proto = torch.randn(num_proto, z_dim, device=device)
+        z = torch.randn(num_query, z_dim, device=device)
+        index = PrototypeIndex(z_proto)
+
+        with torch.inference_mode():
+            _, indices = index.search(z, k)
+            reference = torch.cdist(z, z_proto).topk(k, dim=1, largest=False).indices
+            agreement = (indices == reference).float().mean().item()
+
+            index_ms = benchmark(lambda: index.search(z, k))
+            cdist_ms = benchmark(lambda: torch.cdist(z, z_proto).topk(k, dim=1, largest=False))
+            euclidean_ms = "-"
+            if num_proto <= 10000:
+                euclidean_ms = f"{benchmark(lambda: euclidean_dist(z, z_proto).topk(k, dim=1, largest=False)):.2f}"
+        print(f"{num_proto} | {k} | {index_ms:.2f} | {cdist_ms:.2f} | {euclidean_ms} | {agreement:.4f}")
@@ -0,0 +1,75 @@
+import os
+import torch
+from models.proto import PrototypeIndex
+
+
+class PrototypeStore:
+    def __init__(self, model_hash, device='cpu'):
+        """
+        Class prototypes of one checkpoint, kept across runs so deployment only encodes the query frames
+
+        Args:
+            model_hash (str): checkpoint_hash of the weights the prototypes were encoded with
+        """
+        self.model_hash = model_hash
+        self.device = torch.device(device)
+        self.names = []  # class names from config['total_class']
+        self.prototypes = None  # [K_way, z_dim] running mean of the support embeddings of every class
+        self.counts = torch.zeros(0, dtype=torch.long, device=self.device)  # support frames behind every prototype
+
+    @classmethod
+    def load(cls, path, model_hash, device='cpu'):
+        # an empty store when path does not exist yet
+        store = cls(model_hash, device)
+        if not os.path.exists(path):
+            return store
+
+        state = torch.load(path, map_location=store.device)
+        if state['model_hash'] != model_hash:
+            raise ValueError(f'{path} was built with checkpoint {state["model_hash"]}, not {model_hash}')
+        store.names = list(state['names'])
+        store.prototypes = state['prototypes']
+        store.counts = state['counts']
+        return store
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        state = {'model_hash': self.model_hash, 'names': self.names,
+                 'prototypes': self.prototypes, 'counts': self.counts}
+        tmp_path = path + '.tmp'
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def count(self, name):
+        return int(self.counts[self.names.index(name)]) if name in self else 0
+
+    def update(self, name, z):
+        """
+        Folds new labeled embeddings into the running mean of a class, registering the class
+        (an unseen modulation) if it is not in the store, the other prototypes are left as they are
+
+        Args:
+            z: [n, z_dim] embeddings of frames of class name
+        """
+        z = z.float().to(self.device)
+        if name not in self:
+            self.names.append(name)
+            z_proto = z.mean(0, keepdim=True)
+            self.prototypes = z_proto if self.prototypes is None else torch.cat([self.prototypes, z_proto])
+            self.counts = torch.cat([self.counts, self.counts.new_tensor([len(z)])])
+            return
+
+        i = self.names.index(name)
+        count = self.counts[i]
+        self.prototypes[i] = (self.prototypes[i] * count + z.sum(0)) / (count + len(z))
+        self.counts[i] = count + len(z)
+
+    def classify(self, z, threshold=None):
+        # [N] index into names of the nearest prototype of every embedding, -1 when rejected by threshold
+        return PrototypeIndex(self.prototypes).search(z, threshold=threshold)[1][:, 0]
@@ -43,7 +43,7 @@ class ResidualUnit(nn.Module):
         out = self.relu(out)
 
         if self.max_pool:
-            out = nn.MaxPool2d(kernel_size=(1, 2), stride=(1, 2))(out)
+            out = F.max_pool2d(out, kernel_size=(1, 2), stride=(1, 2))
 
         return out
 
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torchvision.transforms as transforms
 from torchsummary import summary
 from thop import profile
@@ -31,10 +32,8 @@ class MultiHeadAttention(nn.Module):
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]
-        attn = (q @ k.transpose(-2, -1)) / (C // self.num_heads)**0.5
-        attn = attn.softmax(dim=-1)
-        attn = self.att_drop(attn)
-        x = attn @ v
+        # fused softmax(q @ k^T / sqrt(head_dim)) @ v, attention dropout only while training
+        x = F.scaled_dot_product_attention(q, k, v, dropout_p=self.att_drop.p if self.training else 0.0)
         x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
@@ -69,8 +68,15 @@ class ViTBlock(nn.Module):
         return x
 
 class ViT(nn.Module):
-    def __init__(self, in_channels, embed_dim, num_layers, num_heads, mlp_dim, num_classes, patch_size, in_size):
+    def __init__(self, in_channels, embed_dim, num_layers, num_heads, mlp_dim, num_classes, patch_size, in_size,
+                 pos_embed_mode='slice'):
+        """
+        Frames of any length that is a multiple of the patch width are accepted, pos_embed_mode
+        [slice, interpolate] sets how the positional embeddings of in_size are fit to their patches
+        """
         super().__init__()
+        self.patch_size = patch_size
+        self.pos_embed_mode = pos_embed_mode
         self.patch_embed = PatchEmbedding(in_channels, embed_dim, patch_size)
         self.cls_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
         self.pos_embed = nn.Parameter(torch.zeros(1, 1 + (in_size[0]*in_size[1]) // (patch_size[0] * patch_size[1]), embed_dim))
@@ -83,25 +89,121 @@ class ViT(nn.Module):
         self.norm = nn.LayerNorm(embed_dim)
         self.fc = nn.Linear(embed_dim, num_classes)
 
-    def forward(self, x):
-        B, _, _, _ = x.shape
+    def position_embedding(self, num_patches):
+        # [1, 1 + num_patches, embed_dim], the class token keeps its embedding
+        if num_patches == self.pos_embed.shape[1] - 1:
+            return self.pos_embed
+
+        cls_pos, patch_pos = self.pos_embed[:, :1], self.pos_embed[:, 1:]
+        if self.pos_embed_mode == 'slice' and num_patches < patch_pos.shape[1]:
+            # a short frame takes the positions of the first patches of a full frame
+            patch_pos = patch_pos[:, :num_patches]
+        else:
+            patch_pos = F.interpolate(patch_pos.transpose(1, 2), size=num_patches, mode='linear',
+                                      align_corners=False).transpose(1, 2)
+        return torch.cat((cls_pos, patch_pos), dim=1)
+
+    def tokens(self, x):
+        # [B, 1 + num_patches, embed_dim] input of the first block
+        B, _, H, W = x.shape
+        if H % self.patch_size[0] or W % self.patch_size[1]:
+            raise ValueError(f'frame size {H}x{W} is not a multiple of the patch size {self.patch_size}')
         x = self.patch_embed(x)
 
         cls_tokens = self.cls_token.expand(B, -1, -1)
         x = torch.cat((cls_tokens, x), dim=1)
 
-        x = x + self.pos_embed
-        x = self.pos_drop(x)
+        x = x + self.position_embedding(x.shape[1] - 1)
+        return self.pos_drop(x)
+
+    def head(self, x):
+        # embedding of the class token, also used as the head of the intermediate exits
+        x = self.norm(x[:, 0])
+        return self.fc(x)
 
+    def forward(self, x):
+        x = self.tokens(x)
         x = self.blocks(x)
+        return self.head(x)
+
+    def forward_taps(self, x, exit_layers):
+        """
+        Embeddings of the class token after each of the exit_layers (1-based block counts, ascending)
+        Returns [len(exit_layers), B, num_classes]
+        """
+        x = self.tokens(x)
+        taps = []
+        depth = 0
+        for layer in exit_layers:
+            x = self.blocks[depth:layer](x)
+            depth = layer
+            taps.append(self.head(x))
+        return torch.stack(taps)
+
+    def flops(self, frame_size, depth=None):
+        # multiply-adds x 2 of one frame through the patch embedding, depth blocks and the head
+        depth = len(self.blocks) if depth is None else depth
+        num_patches = (frame_size[0] // self.patch_size[0]) * (frame_size[1] // self.patch_size[1])
+        num_tokens = num_patches + 1
+        embed_dim = self.cls_token.shape[-1]
+        mlp_dim = self.blocks[0].mlp.fc1.out_features
+
+        patch = 2 * num_patches * embed_dim * self.patch_embed.proj.weight[0].numel()
+        attn = 2 * num_tokens * embed_dim * 4 * embed_dim + 2 * 2 * num_tokens * num_tokens * embed_dim
+        mlp = 2 * 2 * num_tokens * embed_dim * mlp_dim
+        head = 2 * embed_dim * self.fc.out_features
+        return patch + depth * (attn + mlp) + head
 
-        x = self.norm(x[:, 0])
-        x = self.fc(x)
 
+if __name__ == '__main__':
+    import copy
+    import types
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    def matmul_attention(self, x):
+        # MultiHeadAttention.forward before scaled_dot_product_attention, kept as the parity reference
+        B, N, C = x.shape
+        qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+        attn = (q @ k.transpose(-2, -1)) / (C // self.num_heads)**0.5
+        attn = attn.softmax(dim=-1)
+        attn = self.att_drop(attn)
+        x = attn @ v
+        x = x.transpose(1, 2).reshape(B, N, C)
+        x = self.proj(x)
+        x = self.proj_drop(x)
         return x
 
+    def benchmark(model, input, repeat=20):
+        with torch.inference_mode():
+            for _ in range(3):
+                model(input)
+            if device == "cuda":
+                torch.cuda.synchronize()
+            start_time = time.perf_counter()
+            for _ in range(repeat):
+                model(input)
+            if device == "cuda":
+                torch.cuda.synchronize()
+        return (time.perf_counter() - start_time) / repeat * 1000
+
+    # parity and speed of the fused attention against the matmul reference, checkpoints load into both
+    print("patch | batch | max abs diff | matmul ms | fused ms")
+    for patch_size in [(2, 8), (2, 16), (2, 32)]:
+        model = ViT(in_channels=1, patch_size=patch_size, embed_dim=36, num_layers=8, num_heads=9,
+                    mlp_dim=32, num_classes=24, in_size=[2, 1024]).to(device).eval()
+        reference = copy.deepcopy(model)
+        reference.load_state_dict(model.state_dict())
+        for block in reference.blocks:
+            block.attn.forward = types.MethodType(matmul_attention, block.attn)
+
+        for batch_size in [1, 75, 256]:
+            input = torch.randn(batch_size, 1, 2, 1024, device=device)
+            with torch.inference_mode():
+                diff = (model(input) - reference(input)).abs().max().item()
+            print(f"{patch_size} | {batch_size} | {diff:.2e} | {benchmark(reference, input):.2f} | {benchmark(model, input):.2f}")
 
-if __name__ == '__main__':
     model = ViT(
         in_channels=1,
         patch_size=(2, 16),
@@ -111,10 +213,10 @@ if __name__ == '__main__':
         mlp_dim=32,
         num_classes=24,
         in_size=[2, 1024]
-    ).to("cuda")
-    print(summary(model, (1, 2, 1024)))
+    ).to(device)
+    print(summary(model, (1, 2, 1024), device=device))
 
-    input = torch.randn(1, 1, 2, 1024).cuda()
+    input = torch.randn(1, 1, 2, 1024).to(device)
 
     start_time = time.time()
     outputs = model(input)
@@ -127,7 +229,7 @@ if __name__ == '__main__':
 
     input = torch.randn(1, 1, 2, 1024)
 
-    macs, params = profile(model, inputs=(torch.Tensor(input).to(device="cuda"),))
+    macs, params = profile(model, inputs=(torch.Tensor(input).to(device=device),))
     print(
         "Param: %.2fM | FLOPs: %.3fG" % (params / (1000 ** 2), macs / (1000 ** 3))
-    )
\ No newline at end of file
+    )
@@ -0,0 +1,130 @@
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+from runner.test import Tester
+from runner.utils import autocast
+from data.stream import open_stream, SlidingWindows
+from data.transform import pad_frames, supervised_input
+from models.prototypes import PrototypeStore
+
+
+class Streamer(Tester):
+    def __init__(self, config, model_params):
+        """
+        Sliding-window classification of a continuous I/Q stream with the test checkpoint,
+        meta-learned encoders classify against the prototype store, supervised models with their own head
+        """
+        super(Streamer, self).__init__(config, model_params)
+        self.meta = model_params['lr_mode'] == 'meta'
+        self.store = None
+
+    def prepare(self):
+        self.load_model()
+        self.net.eval()
+        if self.meta:
+            self.store = PrototypeStore.load(self.config['prototype_path'], self.model_hash(), self.device)
+            if len(self.store) == 0:
+                raise ValueError(f'no prototypes in {self.config["prototype_path"]}, run python main.py prototypes first')
+            self.class_names = self.store.names
+        else:
+            self.class_names = self.config['total_class']
+
+    def predict(self, windows):
+        """
+        Args:
+            windows: [N, I/Q, window] strided view of the stream
+        Returns:
+            probs: [N, num_class] class probabilities
+            rejected: [N] windows whose nearest prototype is beyond prototype_reject_threshold
+        """
+        # the strided windows are read-only views of the stream buffer, the batch is materialised here
+        x = torch.from_numpy(np.ascontiguousarray(windows))
+        with torch.inference_mode(), autocast(self.device, self.amp_dtype):
+            if self.meta:
+                z = self.net.encoder(self.net.frames_input(pad_frames(x, self.config['train_sample_len'],
+                                                                      self.config['padding'])))
+                dists = torch.cdist(z.float(), self.store.prototypes)
+                probs = F.softmax(-dists, dim=1)
+                threshold = self.config['prototype_reject_threshold']
+                rejected = torch.zeros(len(x), dtype=torch.bool) if threshold is None else \
+                    dists.min(1).values.pow(2) > threshold
+            else:
+                # same layout as the AMCTestDataset batches: short windows are self duplicated to 1024 samples
+                x = supervised_input(pad_frames(x, 1024, 'self_duplicate'), self.config['model'], robust=self.robust)
+                x = x.to(self.device)
+                if x.dim() == 4:
+                    x = x.contiguous(memory_format=self.memory_format)
+                probs = F.softmax(self.net(x).float(), dim=1)
+                rejected = torch.zeros(len(x), dtype=torch.bool)
+
+        return probs.cpu().numpy(), rejected.cpu().numpy()
+
+    def run(self, source):
+        """
+        Yields one prediction per window of source (see data.stream.open_stream): stream position and time
+        of its first sample, label of the window and label of the probabilities averaged over the last
+        stream_smoothing windows. Per-window latency is measured from the arrival of the chunk completing the window
+        """
+        windows = SlidingWindows(self.config['stream_window'], self.config['stream_hop'])
+        batch_size = self.config['stream_batch']
+        sample_rate = self.config['stream_sample_rate']
+
+        history = []
+        running = 0.0
+        self.num_samples = 0
+        self.latency = []
+
+        for chunk in open_stream(source, self.config['stream_chunk']):
+            arrival = time.perf_counter()
+            self.num_samples += len(chunk)
+            frames, starts = windows.push(chunk)
+
+            for i in range(0, len(frames), batch_size):
+                probs, rejected = self.predict(frames[i:i + batch_size])
+                self.latency.extend([time.perf_counter() - arrival] * len(probs))
+
+                for start, p, unknown in zip(starts[i:i + batch_size], probs, rejected):
+                    # moving average of the class probabilities of the last stream_smoothing windows
+                    history.append(p)
+                    running = running + p
+                    if len(history) > self.config['stream_smoothing']:
+                        running = running - history.pop(0)
+                    smoothed = running / len(history)
+
+                    yield {
+                        'sample': int(start),
+                        'time': start / sample_rate,
+                        'label': 'unknown' if unknown else self.class_names[p.argmax()],
+                        'smoothed': self.class_names[smoothed.argmax()],
+                        'confidence': float(smoothed.max())
+                    }
+
+    def stream(self):
+        self.print_device()
+        self.prepare()
+
+        label = None
+        num_window = 0
+        start_time = time.perf_counter()
+        for prediction in self.run(self.config['stream_source']):
+            num_window += 1
+            # the monitor prints changes of the smoothed label
+            if prediction['smoothed'] != label:
+                label = prediction['smoothed']
+                print(f"{prediction['time']:.6f}s (sample {prediction['sample']}): {label} "
+                      f"({prediction['confidence']:.3f})")
+        elapsed = time.perf_counter() - start_time
+
+        self.report(num_window, elapsed)
+
+    def report(self, num_window, elapsed):
+        # sustained throughput of the whole stream and latency of every window
+        samples_per_sec = self.num_samples / elapsed
+        latency = np.array(self.latency) * 1000
+        print(f'{self.num_samples} samples, {num_window} windows in {elapsed:.2f}s: '
+              f'{samples_per_sec:.0f} samples/s ({samples_per_sec / self.config["stream_sample_rate"]:.2f}x real time), '
+              f'{num_window / elapsed:.1f} windows/s')
+        if len(latency):
+            print(f'window latency: mean {latency.mean():.2f} ms, p50 {np.percentile(latency, 50):.2f} ms, '
+                  f'p99 {np.percentile(latency, 99):.2f} ms')
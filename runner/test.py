@@ -1,41 +1,178 @@
 import os
+import time
 import torch
 import torch.utils.data as DATA
 import torch.nn.functional as F
 import tqdm
 import numpy as np
 import pandas as pd
-from runner.utils import model_selection, result2csv
-from data.dataset import AMCTestDataset, FewShotDataset
+from runner.utils import model_selection, result2csv, mean_ci, get_device, set_cpu_threads, memory_format, amp_dtype, autocast, \
+    encoder_of, quantize_dynamic, quantized_path, optimize_for_inference, compile_encoder, CompiledForward, CONV_MODELS
+from data.dataset import AMCTestDataset, FewShotDataset, loader_kwargs
+from data.sampler import DeviceEpisodeSampler
+from data.plan import load_episode_plan
+from data.embeddings import checkpoint_hash, embedding_key, load_embeddings
+from data.reader import open_index, open_reader, source_identity
+from models.prototypes import PrototypeStore
+from data.transform import pad_frames, supervised_input
 from plot.plotter import plot_confusion_matrix, eval_plotter
 
 class Tester:
     def __init__(self, config, model_params, per_snr=False):
         self.config = config
         self.model_params = model_params
-        self.use_cuda = self.config['cuda']
-        self.device_ids = self.config['gpu_ids']
         self.batch_size = self.model_params["batch_size"]
         self.per_snr = per_snr
         self.model_path = os.path.join(self.config['load_test_path'], self.config['model'], self.config['load_model_name'])
+        # checkpoint of the weights in self.net, keys the embedding cache and the prototype store
+        self.net_path = quantized_path(self.model_path) if self.config['quantized'] else self.model_path
 
         # If variable 'robust' is True, extend frame length to 4 x 1024
         self.robust = True if self.config['model'] == 'robustcnn' else False 
 
+        self.device = get_device(self.config)
+        if self.device.type == 'cpu':
+            set_cpu_threads(self.config)
+        self.memory_format = memory_format(self.config, self.device)
+        self.amp_dtype = amp_dtype(self.config, self.device)
+
+        if self.config['quantized'] and self.device.type != 'cpu':
+            raise ValueError('dynamic INT8 checkpoints run on the CPU, set cuda: False')
+
         self.net = model_selection(self.config, self.model_params, mode='test')
-        if self.use_cuda:
-            self.net = self.net.to(self.device_ids[0])
+        self.net = self.net.to(self.device, memory_format=self.memory_format)
 
-    def test(self):
+    def print_device(self):
         print("Cuda: ", torch.cuda.is_available())
-        print("Device id: ", self.device_ids[0])
+        print("Device: ", self.device)
+        if self.device.type == 'cpu':
+            print(f"CPU threads: {torch.get_num_threads()} intra-op, {torch.get_num_interop_threads()} inter-op")
+        if self.amp_dtype is not None:
+            print(f"Autocast: {self.amp_dtype}")
+
+    def test(self):
+        self.print_device()
         print(f"Model: {self.config['model']}")
 
         snr_range = range(self.config["test_snr_range"][0], self.config["test_snr_range"][1] + 1, 2)
 
         sample_len_list = self.config['test_sample_len']
+        self.load_model()
+        if self.config['compile']:
+            self.warmup(self.example_batch())
+
+        evaluate = self.single_pass_test if self.config['single_pass_eval'] else self.per_snr_test
+        acc_per_size = evaluate(snr_range, sample_len_list)
+
+        if self.amp_dtype is not None and self.config['amp_drift']:
+            self.amp_drift(acc_per_size, evaluate, snr_range, sample_len_list)
+
+        if self.config['quantized']:
+            self.quantization_report(acc_per_size, evaluate, snr_range, sample_len_list)
+
+        if self.config['compile']:
+            encoder_of(self.net).forward.report()
+
+        if self.config['save_result']:
+            result2csv(acc_per_size, sample_len_list, os.path.join(self.config['load_test_path'], self.config['model']))
+        
+        if self.config['show_result']:
+            eval_plotter(snr_range, acc_per_size, sample_len_list)
+
+    def load_model(self):
+        if self.config['quantized']:
+            # the dynamic INT8 modules have to exist before their packed weights are loaded
+            quantize_dynamic(self.net.eval(), self.config)
+            # packed LSTM weights are pickled as ScriptObjects, the file is written by quantize()
+            self.net.load_state_dict(torch.load(self.net_path, map_location=self.device, weights_only=False))
+        else:
+            self.net.load_state_dict(torch.load(self.model_path, map_location=self.device))
+
+        if self.config['optimize_for_inference']:
+            self.optimize_encoder()
+
+    def optimize_encoder(self):
+        """
+        Replaces the encoder by its optimize_for_inference graph after checking that both give the same outputs
+        """
+        if self.config['model'] not in CONV_MODELS:
+            raise ValueError(f"optimize_for_inference supports the conv encoders {CONV_MODELS}, got {self.config['model']}")
+
+        encoder = encoder_of(self.net).eval()
+        compiled = isinstance(encoder.forward, CompiledForward)
+        if compiled:
+            # the eager forward is traced, the optimized graph is compiled again below
+            del encoder.forward
+
+        # random frames in the encoder input layout, zeros would hide folding errors behind the biases
+        x = torch.randn(self.example_batch().shape, generator=torch.Generator().manual_seed(self.config['seed']))
+        x = x.to(self.device).contiguous(memory_format=self.memory_format)
+        with torch.inference_mode():
+            reference = encoder(x)
+        fused = optimize_for_inference(encoder).to(memory_format=self.memory_format)
+        with torch.inference_mode():
+            diff = (fused(x) - reference).abs().max().item()
+
+        print(f'optimize_for_inference: {len(list(encoder.modules()))} -> {len(list(fused.modules()))} modules, '
+              f'max abs diff {diff:.2e}')
+        if not diff <= 1e-4 * max(reference.abs().max().item(), 1.0):
+            raise RuntimeError(f'optimize_for_inference changed the encoder outputs (max abs diff {diff:.2e})')
+
+        if hasattr(self.net, 'encoder'):
+            self.net.encoder = fused
+        else:
+            self.net = fused
+        if compiled:
+            compile_encoder(self.net, self.config, self.model_params)
+
+    def quantize(self):
+        """
+        Saves the dynamic INT8 version of the fp32 checkpoint next to it (49.tar -> 49.int8.tar)
+        """
+        net = model_selection(self.config, self.model_params, mode='test')
+        net.load_state_dict(torch.load(self.model_path, map_location='cpu'))
+        net = quantize_dynamic(net.cpu().eval(), self.config)
+
+        save_path = quantized_path(self.model_path)
+        torch.save(net.state_dict(), save_path)
+        print(f'saved at {save_path} ({os.path.getsize(self.model_path) / 2**20:.2f} MB fp32 -> '
+              f'{os.path.getsize(save_path) / 2**20:.2f} MB int8)')
+
+    def example_batch(self):
+        # encoder input of one full batch (supervised) or one test episode (meta)
+        if self.model_params['lr_mode'] == 'supervised':
+            return supervised_input(torch.zeros(self.batch_size, 2, 1024), self.config['model'], robust=self.robust)
+        num_frame = len(self.config['test_class_indices']) * (self.config['num_support'] + self.config['num_query'])
+        return self.net.encoder_input(torch.zeros(num_frame, 2, self.config['train_sample_len']))
+
+    def latency(self, net, x, repeat=20):
+        # median ms of one encoder forward of x
+        x = x.to(self.device)
+        if x.dim() == 4:
+            x = x.contiguous(memory_format=self.memory_format)
+        encoder = encoder_of(net).eval()
+
+        elapsed = []
+        with torch.inference_mode():
+            encoder(x)
+            for _ in range(repeat):
+                start_time = time.perf_counter()
+                encoder(x)
+                elapsed.append(time.perf_counter() - start_time)
+        return np.median(elapsed) * 1000
+
+    def warmup(self, x):
+        # compiles the encoder graph of a full batch / episode before anything is timed
+        x = x.to(self.device)
+        if x.dim() == 4:
+            x = x.contiguous(memory_format=self.memory_format)
+
+        self.net.eval()
+        with torch.inference_mode(), autocast(self.device, self.amp_dtype):
+            encoder_of(self.net).forward.warmup(x)
+
+    def per_snr_test(self, snr_range, sample_len_list):
         acc_per_size = []
-        self.net.load_state_dict(torch.load(self.model_path))
 
         for sample_len in sample_len_list:
             acc_per_snr = []
@@ -46,23 +183,22 @@ class Tester:
                                            robust=self.robust,
                                            snr_range=[snr, snr],
                                            sample_len=sample_len)
-                test_dataloader = DATA.DataLoader(test_data, batch_size=self.batch_size, shuffle=True)
+                test_dataloader = DATA.DataLoader(test_data, batch_size=self.batch_size, shuffle=True,
+                                                  collate_fn=test_data.collate, **loader_kwargs(self.config))
 
                 correct = 0
                 total = 0
 
                 self.net.eval()
-                with torch.no_grad():
+                with torch.inference_mode():
                     for i, sample in enumerate(tqdm.tqdm(test_dataloader)):
-                        if self.use_cuda:
-                            x = sample["data"].to(self.device_ids[0])
-                            labels = sample["label"].to(self.device_ids[0])
-                            # snr = sample["snr"].to(self.device_ids[0])
-                        else:
-                            x = sample["data"]
-                            labels = sample["label"]
-                        outputs = self.net(x)
-                        outputs = F.softmax(outputs, dim=1)
+                        x = sample["data"].to(self.device, non_blocking=True)
+                        labels = sample["label"].to(self.device, non_blocking=True)
+                        if x.dim() == 4:
+                            x = x.contiguous(memory_format=self.memory_format)
+                        with autocast(self.device, self.amp_dtype):
+                            outputs = self.net(x)
+                        outputs = F.softmax(outputs.float(), dim=1)
 
                         _, pred = torch.max(outputs, 1)
 
@@ -74,24 +210,91 @@ class Tester:
 
             acc_per_size.append(acc_per_snr)
 
-        if self.config['save_result']:
-            result2csv(acc_per_size, sample_len_list, os.path.join(self.config['load_test_path'], self.config['model']))
-        
-        if self.config['show_result']:
-            eval_plotter(snr_range, acc_per_size, sample_len_list)
-        
+        return acc_per_size
+
+    def single_pass_test(self, snr_range, sample_len_list):
+        """
+        Loads the test split of the whole test_snr_range once, groups its rows by SNR
+        and derives every frame length of the sweep from the same frames
+        """
+        # frames are read only up to the longest test_sample_len of the sweep
+        test_data = AMCTestDataset(self.config, robust=self.robust, snr_range=self.config['test_snr_range'],
+                                   sample_len=max(sample_len_list))
+        acc_per_size = [[] for _ in sample_len_list]
+        num_frames = 0
+        start_time = time.perf_counter()
+
+        self.net.eval()
+        with torch.inference_mode():
+            for snr in tqdm.tqdm(snr_range):
+                in_snr = np.flatnonzero(test_data.snr == snr)
+                frames = torch.from_numpy(np.ascontiguousarray(test_data.iq.take(in_snr).transpose(0, 2, 1)))
+                frames = frames.to(self.device)
+                labels = torch.from_numpy(test_data.label[in_snr].astype(np.int64)).to(self.device)
+
+                for i, sample_len in enumerate(sample_len_list):
+                    # short frames are self duplicated up to 1024 samples as in AMCTestDataset
+                    x = pad_frames(frames[..., :sample_len], 1024)
+                    x = supervised_input(x, self.config['model'], robust=self.robust)
+                    if x.dim() == 4:
+                        x = x.contiguous(memory_format=self.memory_format)
+
+                    correct = 0
+                    for start in range(0, len(x), self.batch_size):
+                        with autocast(self.device, self.amp_dtype):
+                            outputs = self.net(x[start:start + self.batch_size])
+                        correct += (outputs.argmax(1) == labels[start:start + self.batch_size]).sum().item()
+
+                    acc_per_size[i].append(correct / len(in_snr))
+                    num_frames += len(in_snr)
+
+        print(f'throughput: {num_frames / (time.perf_counter() - start_time):.1f} frames/s')
+
+        return acc_per_size
 
     def meta_test(self):
-        print("Cuda: ", torch.cuda.is_available())
-        print("Device id: ", self.device_ids[0])
+        self.print_device()
 
         snr_range = range(self.config["test_snr_range"][0], self.config["test_snr_range"][1] + 1, 2)
 
         sample_len_list = self.config['test_sample_len']
         train_sample_len = self.config['train_sample_len']
-        acc_per_size = []
  
-        self.net.load_state_dict(torch.load(self.model_path))
+        self.load_model()
+        if self.config['compile']:
+            self.warmup(self.example_batch())
+
+        if self.config['prototype_eval']:
+            evaluate = self.prototype_test
+        elif self.config['embedding_cache']:
+            evaluate = self.cached_meta_test
+        else:
+            evaluate = self.single_pass_meta_test if self.config['single_pass_eval'] else self.per_snr_meta_test
+        acc_per_size = evaluate(snr_range, sample_len_list, train_sample_len)
+
+        if self.amp_dtype is not None and self.config['amp_drift']:
+            self.amp_drift(acc_per_size, evaluate, snr_range, sample_len_list, train_sample_len)
+
+        if self.config['quantized']:
+            self.quantization_report(acc_per_size, evaluate, snr_range, sample_len_list, train_sample_len)
+
+        if self.config['early_exit_report']:
+            self.early_exit_report(snr_range, sample_len_list, train_sample_len)
+
+        if self.config['eval_shots']:
+            self.shot_report(snr_range, sample_len_list, train_sample_len)
+
+        if self.config['compile']:
+            encoder_of(self.net).forward.report()
+
+        if self.config['save_result']:
+            result2csv(acc_per_size, sample_len_list, os.path.join(self.config['load_test_path'], self.config['model']))
+        
+        if self.config['show_result']:
+            eval_plotter(snr_range, acc_per_size, sample_len_list)
+
+    def per_snr_meta_test(self, snr_range, sample_len_list, train_sample_len):
+        acc_per_size = []
 
         for sample_len in sample_len_list:
             acc_per_snr = []
@@ -106,33 +309,398 @@ class Tester:
                                            sample_len=sample_len,
                                            train_sample_len= train_sample_len)
      
-                test_dataloader = DATA.DataLoader(test_data, batch_size=1, shuffle=True)
+                if self.config['device_sampler']:
+                    # the test split stays on the device, episodes are index gathers there
+                    test_dataloader = DeviceEpisodeSampler.from_dataset(test_data, self.device,
+                                                                        pin_memory=self.config['pin_memory'],
+                                                                        seed=self.config['seed'])
+                else:
+                    # built before the workers start, so they share it instead of each building the plan
+                    test_data.load_plan()
+                    test_dataloader = DATA.DataLoader(test_data, batch_size=1, shuffle=True, collate_fn=test_data.collate,
+                                                      **loader_kwargs(self.config))
 
-                running_acc = 0.0
+                acc_per_snr.append(self.run_episodes(test_dataloader))
 
-                self.net.eval()
-                flag = True
-                with torch.no_grad():
-                    for episode, sample in enumerate(tqdm.tqdm(test_dataloader)):
-                        if flag is True:
-                            print(f'Test support set shape: {sample[0]["support"][0].shape}')
-                            print(f'Test query set shape: {sample[0]["query"][0].shape}')
-                            flag = False
-                        output = self.net.proto_test(sample)
+            acc_per_size.append(acc_per_snr)
+
+        return acc_per_size
+
+    def single_pass_meta_test(self, snr_range, sample_len_list, train_sample_len):
+        """
+        Loads the test split of the whole test_snr_range once, groups its rows by SNR
+        and derives every frame length of the sweep from the same frames
+        """
+        # frames are read only up to the longest test_sample_len of the sweep
+        test_data = FewShotDataset(self.config, mode='test', snr_range=self.config['test_snr_range'],
+                                   sample_len=max(sample_len_list), train_sample_len=train_sample_len)
+        # with device_sampler the frames of an SNR stay on the device, otherwise episodes are gathered on the host
+        device = self.device if self.config['device_sampler'] else 'cpu'
+        acc_per_size = [[] for _ in sample_len_list]
+
+        for snr in snr_range:
+            print(f'SNR: {snr} test start')
+            frames, labels, plan = self.snr_split(test_data, snr, device)
+
+            for i, sample_len in enumerate(sample_len_list):
+                print(f'Size {sample_len} test start')
+                x = pad_frames(frames[..., :sample_len], train_sample_len, self.config['padding'])
+                sampler = DeviceEpisodeSampler(x, labels, test_data.num_support, test_data.num_query, device,
+                                               pin_memory=self.config['pin_memory'], seed=self.config['seed'],
+                                               plan=plan)
+                acc_per_size[i].append(self.run_episodes(sampler))
+
+        return acc_per_size
 
-                        running_acc += output['acc']
+    def snr_split(self, test_data, snr, device):
+        # [N, I/Q, sample_len] frames, labels and episode plan of one SNR of a FewShotDataset
+        in_snr = np.flatnonzero(test_data.snr == snr)
+        frames = torch.from_numpy(np.ascontiguousarray(test_data.iq.take(in_snr).transpose(0, 2, 1)))
+        frames = frames.to(device)
 
-                avg_acc = running_acc / (episode + 1)
-                print(f'avg accuracy: {avg_acc}')
-                acc_per_snr.append(avg_acc)
+        return (frames,) + self.snr_plan(test_data, in_snr)
 
+    def snr_plan(self, test_data, in_snr):
+        # one plan of episodes per SNR, shared by every frame length of the sweep
+        labels = test_data.label_list[in_snr]
+        plan = None
+        if self.config['episode_plan']:
+            num_episode = len(in_snr) // ((test_data.num_support + test_data.num_query) * len(np.unique(labels)))
+            plan = load_episode_plan(self.config['episode_plan_path'], labels, test_data.num_support,
+                                     test_data.num_query, num_episode, self.config['seed'])
+
+        return labels, plan
+
+    def cached_meta_test(self, snr_range, sample_len_list, train_sample_len):
+        """
+        Encodes every test frame once per (checkpoint, frame length, padding) into the embedding cache
+        and evaluates the episodes of each SNR on the cached embeddings only
+        """
+        stats = self.cached_episode_stats(snr_range, sample_len_list, train_sample_len, [self.config['num_support']])
+        return [[acc for acc, _ in acc_per_snr] for acc_per_snr in stats[0]]
+
+    def cached_episode_stats(self, snr_range, sample_len_list, train_sample_len, shot_list):
+        """
+        Mean accuracy and 95% confidence interval of the test episodes of every shot count, frame length and SNR,
+        all episodes of a SNR are scored at once on the cached embeddings
+
+        Args:
+            shot_list: support sizes up to num_support, each uses the first shots of the same episodes
+        Returns:
+            list: [shot][sample_len][snr] (mean accuracy, confidence interval half-width)
+        """
+        if self.config['early_exit']:
+            # only final-layer embeddings are cached, the accuracies would be full depth ones
+            raise ValueError('embedding_cache and eval_shots evaluate the full encoder, unset early_exit')
+
+        test_data = FewShotDataset(self.config, mode='test', snr_range=self.config['test_snr_range'],
+                                   sample_len=max(sample_len_list), train_sample_len=train_sample_len)
+        assert max(shot_list) <= test_data.num_support
+        model_hash = self.model_hash()
+        stats = [[[] for _ in sample_len_list] for _ in shot_list]
+
+        for i, sample_len in enumerate(sample_len_list):
+            print(f'Size {sample_len} test start')
+            embeddings = self.split_embeddings(test_data, sample_len, train_sample_len, model_hash)
+
+            for snr in snr_range:
+                in_snr = np.flatnonzero(test_data.snr == snr)
+                labels, plan = self.snr_plan(test_data, in_snr)
+                z = torch.from_numpy(embeddings[in_snr])
+                sampler = DeviceEpisodeSampler(z, labels, test_data.num_support, test_data.num_query, self.device,
+                                               seed=self.config['seed'], plan=plan)
+
+                start_time = time.perf_counter()
+                positions = sampler.positions()
+                query = positions[:, :, test_data.num_support:]
+                for j, shot in enumerate(shot_list):
+                    acc = self.net.episode_accuracy(sampler.frames, positions[:, :, :shot], query,
+                                                    chunk_episodes=self.config['eval_chunk_episodes'])
+                    stats[j][i].append(mean_ci(acc))
+                    print(f'SNR {snr} {shot}-shot accuracy: {stats[j][i][-1][0]:.4f} +- {stats[j][i][-1][1]:.4f}')
+                print(f'throughput: {len(positions) * len(shot_list) / (time.perf_counter() - start_time):.1f} episodes/s')
+
+        return stats
+
+    def shot_report(self, snr_range, sample_len_list, train_sample_len):
+        # accuracy and confidence interval per shot count, one result2csv table pair per shot
+        shot_list = self.config['eval_shots']
+        stats = self.cached_episode_stats(snr_range, sample_len_list, train_sample_len, shot_list)
+        save_path = os.path.join(self.config['load_test_path'], self.config['model'])
+
+        for shot, stats_per_size in zip(shot_list, stats):
+            acc_per_size = [[acc for acc, _ in acc_per_snr] for acc_per_snr in stats_per_size]
+            ci_per_size = [[ci for _, ci in acc_per_snr] for acc_per_snr in stats_per_size]
+            print(f'{shot}-shot mean accuracy per size: {np.mean(acc_per_size, axis=1).round(4).tolist()}')
+
+            if self.config['save_result']:
+                result2csv(acc_per_size, sample_len_list, save_path, file_name=f'result_{shot}shot.csv')
+                result2csv(ci_per_size, sample_len_list, save_path, file_name=f'result_{shot}shot_ci.csv')
+
+    def split_embeddings(self, test_data, sample_len, train_sample_len, model_hash):
+        """
+        [N, z_dim] embeddings of the frames of test_data. They are cached per modulation-SNR block,
+        so sweeps over shots, ways, unseen classes and SNR ranges reuse the blocks they share
+        """
+        # the dataset file is part of the key, a regenerated or replaced HDF5 never reuses stale embeddings
+        src_size, src_mtime_ns = source_identity(self.config['dataset_path'])
+        params = {'model': self.config['model'], 'sample_len': sample_len, 'frame_len': train_sample_len,
+                  'padding': self.config['padding'], 'pos_embed_mode': self.config['pos_embed_mode'],
+                  'amp': str(self.amp_dtype), 'src_size': src_size, 'src_mtime_ns': src_mtime_ns}
+
+        embeddings = None
+        for label, snr in sorted(set(zip(test_data.label_list.tolist(), test_data.snr.tolist()))):
+            positions = np.flatnonzero((test_data.label_list == label) & (test_data.snr == snr))
+            key = embedding_key(test_data.iq.rows[positions], **params)
+            z = load_embeddings(self.config['embedding_cache_path'], model_hash, key, len(positions),
+                                lambda: self.encode_frames(test_data.iq, positions, sample_len, train_sample_len))
+            if embeddings is None:
+                embeddings = np.empty((len(test_data.iq), z.shape[1]), dtype=np.float32)
+            embeddings[positions] = z
+
+        return embeddings
+
+    def encode_frames(self, iq, positions, sample_len, train_sample_len):
+        # [n, z_dim] float32 embeddings of the frames of reader iq at positions, one encoder forward per batch
+        self.net.eval()
+        with torch.inference_mode():
+            for start in range(0, len(positions), self.batch_size):
+                frames = iq.take(positions[start:start + self.batch_size])[:, :sample_len]
+                frames = torch.from_numpy(np.ascontiguousarray(frames.transpose(0, 2, 1)))
+                x = self.net.frames_input(pad_frames(frames, train_sample_len, self.config['padding']))
+                with autocast(self.device, self.amp_dtype):
+                    z = self.net.encoder(x)
+                yield z.float().cpu().numpy()
+
+    def model_hash(self):
+        # embeddings and prototypes belong to the exact checkpoint that is evaluated
+        return checkpoint_hash(self.net_path)
+
+    def build_prototypes(self):
+        """
+        Adds prototype_shots labeled frames of every class of prototype_classes to the prototype store:
+        classes already stored fold them into their running mean, new (unseen) classes are registered,
+        the other stored prototypes are never re-encoded
+        """
+        self.print_device()
+        self.load_model()
+
+        store = PrototypeStore.load(self.config['prototype_path'], self.model_hash(), self.device)
+        class_indices = self.config['prototype_classes'] or self.config['test_class_indices']
+        train_sample_len = self.config['train_sample_len']
+        num_shot = self.config['prototype_shots']
+
+        # support frames come from the head of each modulation-snr block that the test split never reads
+        index = open_index(self.config['dataset_path'])
+        num_sample = 4096 - int(4096 * self.config['train_proportion'])
+
+        for class_idx in class_indices:
+            name = self.config['total_class'][class_idx]
+            rows = index.select([class_idx], snr_range=self.config['test_snr_range'], split='train',
+                                num_sample=num_sample)
+
+            # every run takes the next frames of a fixed per-class permutation, updates never reuse a frame
+            count = store.count(name)
+            picks = np.random.default_rng([self.config['seed'], class_idx]).permutation(len(rows))
+            picks = np.sort(picks[count:count + num_shot])
+            if len(picks) < num_shot:
+                raise ValueError(f'{name}: {len(rows) - count} unused support frames left, {num_shot} requested')
+
+            iq = open_reader(self.config['dataset_path'], rows[picks], sample_len=train_sample_len)
+            z = np.concatenate(list(self.encode_frames(iq, np.arange(len(picks)), train_sample_len, train_sample_len)))
+            store.update(name, torch.from_numpy(z))
+            print(f'{name}: {"updated" if count else "registered"} with {num_shot} frames ({count + num_shot} total)')
+
+        store.save(self.config['prototype_path'])
+        print(f'{len(store)} prototypes saved at {self.config["prototype_path"]}: {store.names}')
+
+    def prototype_test(self, snr_range, sample_len_list, train_sample_len):
+        """
+        Classifies every test frame of the stored classes against the prototype store,
+        only the test frames are encoded (and cached with embedding_cache)
+        """
+        store = PrototypeStore.load(self.config['prototype_path'], self.model_hash(), self.device)
+        if len(store) == 0:
+            raise ValueError(f'no prototypes in {self.config["prototype_path"]}, run python main.py prototypes first')
+
+        class_indices = [self.config['total_class'].index(name) for name in store.names]
+        test_data = FewShotDataset(dict(self.config, test_class_indices=class_indices), mode='test',
+                                   snr_range=self.config['test_snr_range'], sample_len=max(sample_len_list),
+                                   train_sample_len=train_sample_len)
+
+        # modulation id -> position of its prototype in the store
+        lookup = np.zeros(max(class_indices) + 1, dtype=np.int64)
+        lookup[class_indices] = np.arange(len(class_indices))
+        target = torch.from_numpy(lookup[test_data.label_list]).to(self.device)
+
+        acc_per_size = []
+        for sample_len in sample_len_list:
+            print(f'Size {sample_len} test start')
+            start_time = time.perf_counter()
+            if self.config['embedding_cache']:
+                z = self.split_embeddings(test_data, sample_len, train_sample_len, self.model_hash())
+            else:
+                z = np.concatenate(list(self.encode_frames(test_data.iq, np.arange(len(test_data.iq)), sample_len,
+                                                           train_sample_len)))
+            # frames rejected as unknown by prototype_reject_threshold count as misclassified
+            y_hat = store.classify(torch.from_numpy(z), threshold=self.config['prototype_reject_threshold'])
+            correct = torch.eq(y_hat, target).float()
+            rejected = torch.eq(y_hat, -1).float()
+
+            acc_per_snr = []
+            for snr in snr_range:
+                in_snr = torch.from_numpy(test_data.snr == snr).to(self.device)
+                acc_per_snr.append(correct[in_snr].mean().item())
+                print(f'SNR {snr} accuracy: {acc_per_snr[-1]:.4f}, rejected: {rejected[in_snr].mean().item():.4f}')
             acc_per_size.append(acc_per_snr)
+            print(f'throughput: {len(z) / (time.perf_counter() - start_time):.1f} frames/s')
+
+        return acc_per_size
+
+    def early_exit_report(self, snr_range, sample_len_list, train_sample_len):
+        """
+        Evaluates the episodes of every SNR and frame length at all exit layers of the ViT and reports
+        the exit-depth histogram at exit_thresholds and accuracy vs average query FLOPs for a sweep of
+        thresholds shared by all exits
+        """
+        if self.net.exit_layers is None:
+            raise ValueError(f"early_exit_report needs a ViT encoder (vit_main, vit_sub), got {self.config['model']}")
+
+        test_data = FewShotDataset(self.config, mode='test', snr_range=self.config['test_snr_range'],
+                                   sample_len=max(sample_len_list), train_sample_len=train_sample_len)
+        device = self.device if self.config['device_sampler'] else 'cpu'
+        exit_layers = self.net.exit_layers
+        sweep = [0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99, 0.999, 1.0]
+        rows = []
+
+        self.net.eval()
+        for snr in snr_range:
+            frames, labels, plan = self.snr_split(test_data, snr, device)
 
+            for sample_len in sample_len_list:
+                x = pad_frames(frames[..., :sample_len], train_sample_len, self.config['padding'])
+                sampler = DeviceEpisodeSampler(x, labels, test_data.num_support, test_data.num_query, device,
+                                               seed=self.config['seed'], plan=plan)
+
+                p_y, y_hat, target = [], [], []
+                with torch.inference_mode():
+                    for sample in sampler:
+                        with autocast(self.device, self.amp_dtype):
+                            output = self.net.proto_test_taps(sample)
+                        p_y.append(output['p_y'])
+                        y_hat.append(output['y_hat'])
+                        target.append(output['target'])
+                p_y, y_hat, target = torch.cat(p_y, 1), torch.cat(y_hat, 1), torch.cat(target)
+                correct = (y_hat == target).float()
+                flops = torch.tensor([self.net.encoder.flops((2, x.shape[-1]), layer) for layer in exit_layers],
+                                     dtype=torch.float64, device=correct.device)
+
+                for threshold in ['config'] + sweep:
+                    if threshold == 'config':
+                        thresholds = torch.tensor(self.net.exit_thresholds, device=p_y.device)
+                    else:
+                        thresholds = torch.full((len(exit_layers) - 1,), threshold, device=p_y.device)
+                    # first exit whose probability reaches its threshold, the last exit takes the rest
+                    reached = torch.cat((p_y[:-1] >= thresholds[:, None], torch.ones_like(p_y[:1], dtype=torch.bool)))
+                    exit_index = reached.int().argmax(0)
+
+                    row = {'sample_len': sample_len, 'snr': snr, 'threshold': threshold,
+                           'acc': correct.gather(0, exit_index[None]).mean().item(),
+                           'gflops': flops[exit_index].mean().item() / 1e9}
+                    counts = torch.bincount(exit_index, minlength=len(exit_layers)).tolist()
+                    row.update({f'exit_{layer}': count / len(exit_index) for layer, count in zip(exit_layers, counts)})
+                    rows.append(row)
+
+                    if threshold == 'config':
+                        histogram = ', '.join(f'{layer}: {row[f"exit_{layer}"]:.1%}' for layer in exit_layers)
+                        print(f'SNR {snr} size {sample_len} exits [{histogram}] acc {row["acc"]:.4f} '
+                              f'(full {correct[-1].mean().item():.4f}) {row["gflops"]:.4f} GFLOPs '
+                              f'(full {flops[-1].item() / 1e9:.4f})')
+
+        df = pd.DataFrame(rows)
         if self.config['save_result']:
-            result2csv(acc_per_size, sample_len_list, os.path.join(self.config['load_test_path'], self.config['model']))
-        
-        if self.config['show_result']:
-            eval_plotter(snr_range, acc_per_size, sample_len_list)
+            df.to_csv(os.path.join(self.config['load_test_path'], self.config['model'], 'early_exit.csv'), index=False)
+
+        return df
+
+    def run_episodes(self, episodes):
+        running_acc = 0.0
+        start_time = time.perf_counter()
+
+        self.net.eval()
+        flag = True
+        with torch.inference_mode():
+            for episode, sample in enumerate(tqdm.tqdm(episodes)):
+                if flag is True:
+                    print(f'Test support set shape: {sample["support"].shape}')
+                    print(f'Test query set shape: {sample["query"].shape}')
+                    flag = False
+                with autocast(self.device, self.amp_dtype):
+                    output = self.net.proto_test(sample)
+
+                running_acc += output['acc']
+
+        avg_acc = running_acc / (episode + 1)
+        print(f'avg accuracy: {avg_acc}')
+        print(f'throughput: {(episode + 1) / (time.perf_counter() - start_time):.1f} episodes/s')
+
+        return avg_acc
+
+    def drift_table(self, acc_per_size, reference_acc_per_size, name, reference_name, snr_range, sample_len_list):
+        # accuracy of every SNR and frame length next to a reference run
+        rows = []
+        for i, sample_len in enumerate(sample_len_list):
+            for j, snr in enumerate(snr_range):
+                rows.append({'sample_len': sample_len, 'snr': snr, name: acc_per_size[i][j],
+                             reference_name: reference_acc_per_size[i][j],
+                             'drift': acc_per_size[i][j] - reference_acc_per_size[i][j]})
+        df = pd.DataFrame(rows)
+        print(f'{name} accuracy drift against {reference_name}')
+        print(df.to_string(index=False))
+        print(f'max abs drift: {df["drift"].abs().max():.4f}')
 
+        return df
 
-       
\ No newline at end of file
+    def amp_drift(self, acc_per_size, evaluate, snr_range, sample_len_list, *args):
+        """
+        Evaluates the same episodes / frames again in fp32 and reports the accuracy drift
+        of the autocast run for every SNR and frame length
+        """
+        amp = self.amp_dtype
+        self.amp_dtype = None
+        fp32_acc_per_size = evaluate(snr_range, sample_len_list, *args)
+        self.amp_dtype = amp
+
+        df = self.drift_table(acc_per_size, fp32_acc_per_size, 'amp', 'fp32', snr_range, sample_len_list)
+        if self.config['save_result']:
+            df.to_csv(os.path.join(self.config['load_test_path'], self.config['model'], 'amp_drift.csv'), index=False)
+
+    def quantization_report(self, acc_per_size, evaluate, snr_range, sample_len_list, *args):
+        """
+        Evaluates the same episodes / frames with the fp32 checkpoint and reports the accuracy delta of
+        the INT8 model for every SNR, its encoder latency and checkpoint size against fp32
+        """
+        int8_net = self.net
+        fp32_net = model_selection(self.config, self.model_params, mode='test')
+        fp32_net = fp32_net.to(self.device, memory_format=self.memory_format)
+        fp32_net.load_state_dict(torch.load(self.model_path, map_location=self.device))
+
+        # the fp32 pass reads and writes the embedding cache of the fp32 checkpoint
+        self.net, self.net_path = fp32_net, self.model_path
+        fp32_acc_per_size = evaluate(snr_range, sample_len_list, *args)
+        self.net, self.net_path = int8_net, quantized_path(self.model_path)
+
+        df = self.drift_table(acc_per_size, fp32_acc_per_size, 'int8', 'fp32', snr_range, sample_len_list)
+
+        x = self.example_batch()
+        fp32_latency, int8_latency = self.latency(fp32_net, x), self.latency(int8_net, x)
+        fp32_size = os.path.getsize(self.model_path) / 2**20
+        int8_size = os.path.getsize(quantized_path(self.model_path)) / 2**20
+        print(f'encoder latency ({len(x)} frames): {fp32_latency:.2f} ms fp32 -> {int8_latency:.2f} ms int8 '
+              f'({fp32_latency / int8_latency:.2f}x)')
+        print(f'checkpoint size: {fp32_size:.2f} MB fp32 -> {int8_size:.2f} MB int8 ({fp32_size / int8_size:.2f}x)')
+
+        if self.config['save_result']:
+            df['fp32_latency_ms'], df['int8_latency_ms'] = fp32_latency, int8_latency
+            df['fp32_size_mb'], df['int8_size_mb'] = fp32_size, int8_size
+            df.to_csv(os.path.join(self.config['load_test_path'], self.config['model'], 'quantization.csv'), index=False)
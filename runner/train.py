@@ -5,16 +5,15 @@ import torch.utils.data as DATA
 import torch.nn.functional as F
 import tqdm
 from datetime import datetime
-from runner.utils import model_selection, torch_seed
-from data.dataset import AMCTrainDataset, FewShotDataset
+from runner.utils import model_selection, torch_seed, get_device, set_cpu_threads, amp_dtype, autocast, encoder_of
+from data.dataset import AMCTrainDataset, FewShotDataset, loader_kwargs
 
 
 class Trainer:
     def __init__(self, config, model_params, model_path=None):
         self.config = config
         self.model_params = model_params
-        self.use_cuda = self.config['cuda']
-        self.device_ids = self.config['gpu_ids']
+        self.device = get_device(self.config)
         self.batch_size = self.model_params["batch_size"]
         self.model_path = model_path
         self.save_path = os.path.join(self.config["save_path"], self.config['model'])
@@ -24,24 +23,30 @@ class Trainer:
         # If variable 'robust' is True, extend frame length to 4 x 1024
         self.robust = True if self.config['model'] == 'robustcnn' else False 
        
-        if self.use_cuda:
-            self.net = self.net.to(self.device_ids[0])
-            self.loss = self.loss.to(self.device_ids[0])
+        if self.device.type == 'cpu':
+            set_cpu_threads(self.config)
+        self.net = self.net.to(self.device)
+        self.loss = self.loss.to(self.device)
+
+        # fp16 gradients are loss-scaled, bf16 keeps the fp32 exponent range and needs no scaler
+        self.amp_dtype = amp_dtype(self.config, self.device)
+        self.scaler = torch.amp.GradScaler(self.device.type, enabled=self.amp_dtype == torch.float16)
 
     '''
     Supervised Learning
     '''
     def train(self):
         print("Cuda: ", torch.cuda.is_available())
-        print("Device id: ", self.device_ids[0])
+        print("Device: ", self.device)
         print(f"Model: {self.config['model']}")
 
         os.makedirs(self.save_path, exist_ok=True)
         train_data = AMCTrainDataset(self.config, robust=self.robust)
-        train_dataloader = DATA.DataLoader(train_data, batch_size=self.batch_size, shuffle=True)
+        train_dataloader = DATA.DataLoader(train_data, batch_size=self.batch_size, shuffle=True,
+                                           collate_fn=train_data.collate, **loader_kwargs(self.config))
 
         if self.model_path is not None:
-            self.net.load_state_dict(torch.load(self.model_path))
+            self.net.load_state_dict(torch.load(self.model_path, map_location=self.device))
 
         for epoch in range(self.model_params["epoch"]):
             print('Epoch {}/{}'.format(epoch + 1, self.model_params["epoch"]))
@@ -58,16 +63,18 @@ class Trainer:
                 x = sample["data"]
                 labels = sample["label"]
 
-                if self.use_cuda:
-                    x = x.to(self.device_ids[0])
-                    labels =labels.to(self.device_ids[0])
+                x = x.to(self.device, non_blocking=True)
+                labels = labels.to(self.device, non_blocking=True)
 
                 self.optimizer.zero_grad()
 
-                outputs = self.net(x)
+                with autocast(self.device, self.amp_dtype):
+                    outputs = self.net(x)
+                outputs = outputs.float()
                 loss = self.loss(outputs, labels)
-                loss.backward()
-                self.optimizer.step()
+                self.scaler.scale(loss).backward()
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
 
                 outputs = F.softmax(outputs, dim=1)
                 _, pred = torch.max(outputs, 1)
@@ -86,6 +93,8 @@ class Trainer:
             print(f'Accuracy: : {correct / total}')
 
             self.scheduler.step()
+            if self.config['compile']:
+                encoder_of(self.net).forward.report()
 
             torch.save(self.net.state_dict(), os.path.join(save_path, "{}.tar".format(epoch)))
             print("saved at {}".format(os.path.join(save_path, "{}.tar".format(epoch))))
@@ -95,15 +104,18 @@ class Trainer:
     '''
     def meta_train(self):
         print("Cuda: ", torch.cuda.is_available())
-        print("Device id: ", self.device_ids[0])
+        print("Device: ", self.device)
         print(f"Model: {self.config['model']}")
 
         os.makedirs(self.save_path, exist_ok=True)
         train_data = FewShotDataset(self.config,
-                                    snr_range=self.config['snr_range'],
-                                    sample_len=self.config["train_sample_size"])
+                                    snr_range=self.config['train_snr_range'],
+                                    sample_len=self.config["train_sample_len"])
 
-        train_dataloader = DATA.DataLoader(train_data, batch_size=1, shuffle=True)
+        # episode_batch episodes are stacked into one encoder forward and one optimizer step
+        train_dataloader = DATA.DataLoader(train_data, batch_size=self.model_params['episode_batch'], shuffle=True,
+                                           collate_fn=train_data.collate,
+                                           **loader_kwargs(self.config))
 
         # fix torch seed
         torch_seed(0)
@@ -118,17 +130,21 @@ class Trainer:
 
             for episode, sample in enumerate(tqdm.tqdm(train_dataloader)):
                 self.optimizer.zero_grad()
-                loss, output = self.net.proto_train(sample)
+                with autocast(self.device, self.amp_dtype):
+                    loss, output = self.net.proto_train(sample)
                 train_loss += output['loss']
                 train_acc += output['acc']
-                loss.backward()
-                self.optimizer.step()
+                self.scaler.scale(loss).backward()
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
 
 
             epoch_loss = train_loss / (episode+1)
             epoch_acc = train_acc / (episode+1)
             print('Epoch {:d} -- Loss: {:.4f} Acc: {:.4f}'.format(epoch + 1, epoch_loss, epoch_acc))
             self.scheduler.step()
+            if self.config['compile']:
+                encoder_of(self.net).forward.report()
 
             os.makedirs(self.config["save_path"], exist_ok=True)
             torch.save(self.net.state_dict(), os.path.join(self.save_path, "{}.tar".format(epoch)))
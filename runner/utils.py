@@ -1,12 +1,17 @@
 import os
 import yaml
 import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.fx as fx
+from torch.fx.experimental.optimization import fuse
 import logging
 import numpy as np
 import pandas as pd
 import random
 import importlib
 import inspect
+import time
 import matplotlib.pyplot as plt
 
 # get configs
@@ -18,6 +23,46 @@ def get_function_arguments(func):
     args = inspect.getfullargspec(func).args
     return args
 
+# encoders built from Conv2d layers, the CPU backend runs them channels-last
+CONV_MODELS = ['protonet', 'resnet', 'robustcnn']
+
+def get_device(config):
+    # cuda: False (or a host without a GPU) runs everything on the CPU backend
+    if config['cuda'] and torch.cuda.is_available():
+        return torch.device(f"cuda:{config['gpu_ids'][0]}")
+    return torch.device('cpu')
+
+def set_cpu_threads(config):
+    # null keeps the torch defaults (intra-op: physical cores, inter-op: cores)
+    if config['cpu_threads']:
+        torch.set_num_threads(config['cpu_threads'])
+    if config['cpu_interop_threads'] and torch.get_num_interop_threads() != config['cpu_interop_threads']:
+        try:
+            torch.set_num_interop_threads(config['cpu_interop_threads'])
+        except RuntimeError:
+            # the inter-op pool can only be sized before its first parallel work
+            print('cpu_interop_threads ignored, the inter-op thread pool is already running')
+
+def memory_format(config, device):
+    # oneDNN convolutions are faster on NHWC tensors, GPU runs keep the checkpoint layout
+    if device.type == 'cpu' and config['channels_last'] and config['model'] in CONV_MODELS:
+        return torch.channels_last
+    return torch.contiguous_format
+
+def amp_dtype(config, device):
+    # autocast dtype of the encoder forwards, null runs in fp32
+    if config['amp'] is None:
+        return None
+    if device.type == 'cpu':
+        # CPU autocast runs in bf16 (AVX512-BF16 / AMX on recent Xeons)
+        return torch.bfloat16
+    if config['amp'] == 'bf16' and torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    return torch.float16
+
+def autocast(device, dtype):
+    return torch.autocast(device.type, dtype=dtype or torch.bfloat16, enabled=dtype is not None)
+
 def model_selection(config, model_params, mode='train'):
     model_name = config['model']
 
@@ -56,9 +101,15 @@ def model_selection(config, model_params, mode='train'):
         net = model_class(**relevant_args)
     else:
         function_args = get_function_arguments(model_class)
+        if inspect.getfullargspec(model_class).varkw:
+            # loaders taking **kwargs (load_protonet_conv) get every model argument
+            function_args = [key for key in model_info if key not in ['module', 'class', 'optimizer']]
         relevant_args = {key: model_info[key] for key in function_args if key in model_info}
         net = model_class(**relevant_args)
 
+    if config['compile']:
+        compile_encoder(net, config, model_params)
+
     if mode == 'train':
         optimizer = model_info['optimizer'](net.parameters(), lr=model_params['lr'])
         scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=10, gamma=model_params['lr_gamma'])
@@ -67,6 +118,159 @@ def model_selection(config, model_params, mode='train'):
     else:
         return net
 
+# models whose Linear / LSTM layers carry the compute, the others are conv encoders
+QUANTIZED_MODELS = ['vit_main', 'vit_sub', 'daelstm_meta', 'daelstm_super']
+
+def quantize_dynamic(net, config):
+    """
+    Replaces the nn.Linear (ViT qkv, proj, MLP, fc) and nn.LSTM (DAELSTM) layers of net in place
+    with dynamic INT8 versions: int8 weights, activations quantized per batch, CPU only
+    """
+    if config['model'] not in QUANTIZED_MODELS:
+        raise ValueError(f"dynamic INT8 quantization supports {QUANTIZED_MODELS}, got {config['model']}")
+    return torch.ao.quantization.quantize_dynamic(net, {nn.Linear, nn.LSTM}, dtype=torch.qint8, inplace=True)
+
+def quantized_path(model_path):
+    # 49.tar -> 49.int8.tar
+    root, ext = os.path.splitext(model_path)
+    return root + '.int8' + ext
+
+class ConvReLU2d(nn.Conv2d):
+    # Conv2d with the following ReLU applied in place on its output, one module call instead of two
+    def forward(self, x):
+        return F.relu(self._conv_forward(x, self.weight, self.bias), inplace=True)
+
+    @classmethod
+    def from_conv(cls, conv):
+        fused = cls(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride, padding=conv.padding,
+                    dilation=conv.dilation, groups=conv.groups, bias=conv.bias is not None,
+                    padding_mode=conv.padding_mode).to(conv.weight.device)
+        fused.load_state_dict(conv.state_dict())
+        return fused
+
+def optimize_for_inference(model):
+    """
+    Inference copy of a CNN encoder (eval mode only): BatchNorm2d is folded into the weights of the
+    preceding Conv2d, Conv2d + ReLU run as ConvReLU2d, and modules that are identities at
+    inference (Dropout, AlphaDropout, Identity) are dropped from the traced graph
+    Returns a torch.fx.GraphModule with the outputs of model
+    """
+    gm = fuse(model.eval())
+    modules = dict(gm.named_modules())
+
+    for node in list(gm.graph.nodes):
+        if node.op == 'call_module' and isinstance(modules[node.target], (nn.Dropout, nn.AlphaDropout, nn.Identity)):
+            node.replace_all_uses_with(node.args[0])
+            gm.graph.erase_node(node)
+            continue
+
+        is_relu = (node.op == 'call_module' and isinstance(modules[node.target], nn.ReLU)) or \
+                  (node.op == 'call_function' and node.target in [F.relu, torch.relu])
+        conv = node.args[0] if is_relu else None
+        # the conv output may only feed the ReLU, which then overwrites it
+        if isinstance(conv, fx.Node) and conv.op == 'call_module' and type(modules[conv.target]) is nn.Conv2d \
+                and len(conv.users) == 1:
+            parent, _, name = conv.target.rpartition('.')
+            setattr(gm.get_submodule(parent), name, ConvReLU2d.from_conv(modules[conv.target]))
+            node.replace_all_uses_with(conv)
+            gm.graph.erase_node(node)
+
+    gm.graph.eliminate_dead_code()
+    gm.delete_all_unused_submodules()
+    gm.recompile()
+
+    return gm
+
+def compile_buckets(config, model_params):
+    # batch sizes the encoder sees: supervised batches, or the support set / whole episodes of a forward
+    if model_params['lr_mode'] == 'supervised':
+        return [model_params['batch_size']]
+
+    num_shot = config['num_support'] + config['num_query']
+    train_way = len(config['train_class_indices'])
+    test_way = len(config['test_class_indices'])
+    return sorted({train_way * num_shot * model_params['episode_batch'],
+                   test_way * num_shot, test_way * config['num_support']})
+
+def encoder_of(net):
+    # meta models encode with ProtoNet.encoder, supervised models are the encoder
+    return net.encoder if hasattr(net, 'encoder') else net
+
+def compile_encoder(net, config, model_params):
+    """
+    Replaces the forward of the encoder (ProtoNet.encoder, or the supervised net itself)
+    with a torch.compile'd and shape bucketed one, parameters and state_dict keys are unchanged
+    """
+    encoder = encoder_of(net)
+    # one graph per (bucket, input shape, train/eval) must stay under the recompile limit
+    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64)
+    encoder.forward = CompiledForward(encoder.forward, compile_buckets(config, model_params), config['compile_mode'])
+
+    return net
+
+class CompiledForward:
+    def __init__(self, forward, buckets, mode='default'):
+        """
+        torch.compile'd forward of an encoder module. Eval batches are zero-padded up to the next
+        bucket (the listed sizes, then powers of two), so every frame length compiles one graph per
+        bucket instead of one per batch size. Training batches are not padded, the padding rows
+        would enter the BatchNorm statistics
+
+        Args:
+            forward: bound forward method of the encoder
+            buckets (list): batch sizes compiled as they are
+            mode (str): torch.compile mode [default, reduce-overhead, max-autotune]
+        """
+        self.module = forward.__self__
+        self.forward = torch.compile(forward, mode=mode, dynamic=False)
+        self.buckets = sorted(buckets)
+        self.compile_time = dict()
+        self.latency = dict()
+
+    def bucket(self, n):
+        for size in self.buckets:
+            if size >= n:
+                return size
+        return 1 << (n - 1).bit_length()
+
+    def __call__(self, x):
+        n = len(x)
+        size = n if self.module.training else self.bucket(n)
+        if size > n:
+            padded = x.new_zeros((size,) + x.shape[1:])
+            if x.dim() == 4 and x.is_contiguous(memory_format=torch.channels_last):
+                padded = padded.contiguous(memory_format=torch.channels_last)
+            padded[:n] = x
+            x = padded
+
+        key = (size,) + tuple(x.shape[1:]) + (('train' if self.module.training else 'eval'),)
+        start_time = time.perf_counter()
+        out = self.forward(x)
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+        elapsed = time.perf_counter() - start_time
+
+        if key not in self.compile_time:
+            # the first call of a shape traces and compiles its graph
+            self.compile_time[key] = elapsed
+            print(f'compiled {key} in {elapsed:.1f}s')
+        else:
+            self.latency.setdefault(key, []).append(elapsed)
+
+        return out[:n]
+
+    def warmup(self, x, steps=3):
+        # compiles the graph of x and settles its caches, the warmup batches are not timed
+        for _ in range(steps):
+            self(x)
+        self.latency.pop((self.bucket(len(x)),) + tuple(x.shape[1:]) + ('eval',), None)
+
+    def report(self):
+        for key, elapsed in self.compile_time.items():
+            latency = self.latency.get(key, [])
+            steady = f'{np.median(latency) * 1000:.2f} ms/batch over {len(latency)} batches' if latency else 'no steady-state batches'
+            print(f'compile {key}: {elapsed:.1f}s, {steady}')
+
 def euclidean_dist(x, y):
     """
     Computes euclidean distance btw x and y
@@ -118,9 +322,17 @@ def torch_seed(random_seed):
     np.random.seed(random_seed)
     random.seed(random_seed)
 
-def result2csv(result_list, size_list, save_path):
+def result2csv(result_list, size_list, save_path, file_name='result.csv'):
     tmp_dict = dict()
     for i, size in enumerate(size_list):
         tmp_dict[size] = result_list[i]
     df = pd.DataFrame(tmp_dict)
-    df.to_csv(os.path.join(save_path, 'result.csv'), index=False)
+    df.to_csv(os.path.join(save_path, file_name), index=False)
+
+
+def mean_ci(acc, z=1.96):
+    # mean and 95% confidence interval half-width of per-episode accuracies
+    acc = torch.as_tensor(acc, dtype=torch.float64)
+    if len(acc) < 2:
+        return acc.mean().item(), 0.0
+    return acc.mean().item(), (z * acc.std() / len(acc) ** 0.5).item()